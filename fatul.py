@@ -13,17 +13,32 @@
 
 import argparse
 import base64
+import codecs
 import json
+import os
 import re
+import shlex
 import sys
 import textwrap
+import threading
+import time
 import zlib
 import hashlib
+import heapq
+import io
+import logging
+import operator
+from collections import Counter
+from contextvars import ContextVar, copy_context
+from contextlib import contextmanager, nullcontext, redirect_stderr, redirect_stdout
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from itertools import groupby
+from functools import lru_cache
+from itertools import chain, groupby, repeat
 from pathlib import Path
 from traceback import format_exception
-from typing import List, Any, Literal, NewType, Tuple, Dict, get_args, Union, Optional
+from typing import (BinaryIO, Callable, Iterable, Iterator, List, Set, TextIO, Any, Literal, NewType, Tuple, Dict,
+                    get_args, Union, Optional)
 
 try:
     # Optionally allow clipboard access
@@ -31,6 +46,18 @@ try:
 except ImportError:
     pyperclip = None
 
+try:
+    # Peak memory usage is only reported on the platforms that support it
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # Optionally use vectorized operations for large blueprints
+    import numpy
+except ImportError:
+    numpy = None
+
 # Larger entities are more likely to stay in the same place, so boost their score penalty
 ENTITY_SCORES = {
     "assembling-machine-1": 2,
@@ -54,6 +81,34 @@ ENTITY_SCORES = {
 }
 
 MAX_LINE_LENGTH = 100
+# Smaller blueprints are faster to process without NumPy
+NUMPY_MIN_ENTITIES = 256
+# Maximum number of old and new entity pairs compared when guessing the shift
+MERGE_VOTE_BUDGET = 250_000
+# Number of the best voted shifts that are verified against all entities
+MERGE_VOTE_CANDIDATES = 8
+# Minimum share of the (score-weighted) new entities that must match the old ones after the shift
+MERGE_VOTE_MIN_MATCH = 0.1
+# Increase when the format of the encode cache file, or the content it stores, changes
+ENCODE_CACHE_VERSION = 1
+# Increase when the decoded files may change even if the blueprint string and the decode options are the same
+FINGERPRINTS_VERSION = 1
+FINGERPRINTS_FILE = ".fatul-fingerprints.json"
+# Number of the smallest entity hashes kept in the signature of a blueprint when matching it to the existing files
+FILE_MATCH_SKETCH_SIZE = 64
+# Minimum estimated share of the same entities for a blueprint to be decoded into an existing file of another name
+FILE_MATCH_MIN_SIMILARITY = 0.5
+# Number of the slowest blueprints listed by --stats
+STATS_MAX_BLUEPRINTS = 10
+READ_CHUNK_SIZE = 1 << 16
+# Size of the square grid cells of the SpatialIndex, in tiles
+SPATIAL_CELL_SIZE = 32
+# Increase when the textconv output may change for the same blueprint string
+TEXTCONV_CACHE_VERSION = 1
+TEXTCONV_CACHE_SIZE = 64 << 20
+# Maximum data size of a git pkt-line packet, without its 4-byte length header
+PKT_LINE_MAX_DATA = 65516
+WRITE_CHUNK_SIZE = 1 << 16
 COORD_MULTIPLIER = 16
 SORT_ORDER = {
     "name": "0",
@@ -63,18 +118,69 @@ SORT_ORDER = {
     "_simple": "8",  # other keys with simple values
     "_complex": "9",  # other keys with list and dict values
 }
+BASE64_IGNORED_RE = re.compile(r"[^A-Za-z0-9+/=]+")
+JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+BOOK_START_RE = re.compile(r'[ \t\n\r]*\{[ \t\n\r]*"blueprint_book"[ \t\n\r]*:')
+# Keys of the blueprint book and blueprint values that are encoded one element at a time
+JSON_STREAM_KEYS = {"blueprint_book", "blueprint", "blueprints", "entities", "tiles", "schedules", "wires"}
 COMPLEX_TYPES = {dict, list}
 NUMBER_TYPES = (int, float)
+# Values that are not likely to stay the same, and are ignored by get_obj_hash()
+HASH_VOLATILE_KEYS = {"connections", "position", "entity_id", "entity_number", "entity_rel", "neighbours"}
 SPECIAL_REF_TYPES = {"locomotives", "wires", "stock_connections"}
+# Top level keys of the entities that usually contain references
+ENTITY_REFERENCE_KEYS = {"connections", "neighbours"}
+# Entity values with fewer items are walked without checking if they have any references
+REFERENCE_CHECK_MIN_SIZE = 8
+# Number of the parsed and formatted relative IDs kept in memory, most of them are small offsets that often repeat
+REL_ID_CACHE_SIZE = 1 << 14
+# Positions are packed into a single int as x * POSITION_PACK_FACTOR + y, see pack_position().
+# The packing is linear, so a packed offset can be added to a packed position.
+POSITION_PACK_FACTOR = 1 << 32
+# Maximum absolute y value of the positions and of the relative offsets (see coord_to_int), so that their sum
+# is still within ±POSITION_PACK_FACTOR/2 and cannot be mistaken for a different packed position
+POSITION_MAX_Y = POSITION_PACK_FACTOR // 4
+# Number of the key sets with their value types kept in memory by sort_dict()
+KEY_ORDER_CACHE_SIZE = 1 << 12
 IdsMode = Literal["refs", "mixed", "keep"]
-SortMode = Literal["all", "entities", "keys", "none"]
-Position = NewType("Position", Tuple[int, int])
+SortMode = Literal["all", "hilbert", "entities", "keys", "none"]
+SortCurve = Literal["morton", "hilbert"]
+StatsFormat = Literal["text", "json"]
+GitStoreMode = Literal["decoded", "raw"]
+Position = NewType("Position", int)
 EID = NewType("EID", int)
 HistogramKey = NewType("HistogramKey", Union[int, Tuple[int, str]])
 Histogram = NewType("Histogram", List[Tuple[HistogramKey, int]])
 
+# Messages of the library API calls are passed to this callback instead of being printed to STDERR.
+# Each thread (and asyncio task) has its own value, so that concurrent calls do not mix their messages.
+_log_callback: ContextVar[Optional[Callable[[str], None]]] = ContextVar("_log_callback", default=None)
+# Set while running a serve request
+_clipboard_disabled: ContextVar[bool] = ContextVar("_clipboard_disabled", default=False)
+# Top level keys of the entities that are known to contain references, by entity name.
+# Learned by IdEncoder._may_have_references(), and shared by all blueprints.
+# Keys are cached rather than deeper paths: only a whole top level value can be proven
+# free of references, and values inside it are walked anyway when sorting or hashing.
+_reference_keys_by_name: Dict[Optional[str], Set[str]] = {}
+logger = logging.getLogger("fatul")
+
 
 def main():
+    parser = make_parser()
+    args = parser.parse_args()
+    if args is None:
+        parser.print_help(file=sys.stderr)
+    else:
+        try:
+            args.func(args)
+        except Exception as ex:
+            message = str(ex)
+            if args.verbose or message == "":
+                message += "\n\n" + "".join(format_exception(type(ex), ex, ex.__traceback__))
+            parser.error(message)
+
+
+def make_parser() -> argparse.ArgumentParser:
     # Top level
     parser = argparse.ArgumentParser(
         description="This tool helps to manage Factorio blueprints.")
@@ -86,6 +192,12 @@ def main():
         help="Decode a blueprint from clipboard, a file, or stdin")
     decoder.set_defaults(func=decode_cmd)
     decoder.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    decoder.add_argument("--stats", action="store_const", const="text",
+                         help="Print the time of each processing phase, entity and reference counts, "
+                              "data sizes, and peak memory usage to STDERR. With --jobs, merging and formatting "
+                              "the files in the worker processes is only reported as a single write phase.")
+    decoder.add_argument("--stats-json", dest="stats", action="store_const", const="json",
+                         help="Same as --stats, but print the statistics as a single line of JSON")
     decoder.add_argument("--ids", choices=get_args(IdsMode), default="refs",
                          help=textwrap.dedent("""\
                          How to process the entity_number and entity_id values - '%(default)s' by default
@@ -101,6 +213,8 @@ def main():
                          help=textwrap.dedent("""\
                          Order keys and entities in the output. (default = '%(default)s').
                             * all      - apply all sorting rules.
+                            * hilbert  - same as all, but order entities along a Hilbert curve
+                                         instead of a Z-order curve.
                             * entities - sort entities by their position, trying to keep nearby entities together.
                             * keys     - sort object keys alphabetically, moving 'name' to the top.
                             * none     - do not sort."""))
@@ -114,6 +228,24 @@ def main():
     decoder.add_argument("--no-shift-merge", dest="merge_shift", default=True, action="store_false",
                          help="If the output file already exists, do not try to shift the new entities "
                               "to fit the location of the old ones")
+    decoder.add_argument("--merge-budget", dest="merge_budget", type=int, default=MERGE_VOTE_BUDGET,
+                         help="Maximum number of entity pairs compared when matching the new entities "
+                              "to the old ones. If no match is found within the budget, the x and y shifts "
+                              "are guessed separately from the entity histograms. (default = %(default)s)")
+    decoder.add_argument("--jobs", "-j", type=int, default=1,
+                         help="Number of worker processes used to process and write the entries "
+                              "of a blueprint book. Use 0 for all CPU cores. (default = %(default)s)")
+    decoder.add_argument("--stream", action="store_true",
+                         help="Decode a blueprint book one entry at a time to limit memory usage. "
+                              "Only used when the destination is a directory.")
+    decoder.add_argument("--incremental", action="store_true",
+                         help="Skip the entries of a blueprint book that have not changed since the previous "
+                              f"decode into the same directory. Uses {FINGERPRINTS_FILE} files to track the changes.")
+    decoder.add_argument("--file-match", dest="match_files", action="store_true",
+                         help="When decoding a blueprint book into an existing directory, match its blueprints "
+                              "to the existing files by their entities, so that a renamed or reordered blueprint "
+                              "is merged with its own old file, which is renamed to match the new label. "
+                              "Not used with --stream.")
     decoder.add_argument("--shift-x", dest="shift_x", type=int, help="Override shift_x value")
     decoder.add_argument("--shift-y", dest="shift_y", type=int, help="Override shift_y value")
     decoder.add_argument("destination", type=Path,
@@ -130,10 +262,22 @@ def main():
              "This is identical to   decode --ids=keep --sort=none")
     dumper.set_defaults(func=dump_cmd)
     dumper.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    dumper.add_argument("--stats", action="store_const", const="text",
+                        help="Print the time of each processing phase, entity and reference counts, "
+                             "data sizes, and peak memory usage to STDERR. With --jobs, merging and formatting "
+                             "the files in the worker processes is only reported as a single write phase.")
+    dumper.add_argument("--stats-json", dest="stats", action="store_const", const="json",
+                        help="Same as --stats, but print the statistics as a single line of JSON")
     dumper.add_argument("--pretty", "-p", dest="compact", default=True, action="store_false",
                         help="Use standard JSON formatting instead of compact")
     dumper.add_argument("--sort", "-s", dest="sort", default=False, action="store_true",
                         help="Sort output by keys")
+    dumper.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes used to process and write the entries "
+                             "of a blueprint book. Use 0 for all CPU cores. (default = %(default)s)")
+    dumper.add_argument("--stream", action="store_true",
+                        help="Decode a blueprint book one entry at a time to limit memory usage. "
+                             "Only used when the destination is a directory.")
     dumper.add_argument("destination", type=Path,
                         help="The destination file or directory to write to. "
                              "Use '-' to write to STDOUT as a single formatted JSON.")
@@ -147,81 +291,1084 @@ def main():
         help="Encode a blueprint from a file, directory, or stdin")
     encoder.set_defaults(func=encode_cmd)
     encoder.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    encoder.add_argument("--stats", action="store_const", const="text",
+                         help="Print the time of each processing phase, entity and reference counts, "
+                              "data sizes, and peak memory usage to STDERR")
+    encoder.add_argument("--stats-json", dest="stats", action="store_const", const="json",
+                         help="Same as --stats, but print the statistics as a single line of JSON")
+    encoder.add_argument("--cache", type=Path,
+                         help="Cache file to speed up repeated encoding of the same directory. "
+                              "Only new and modified files are processed again, "
+                              "and an unchanged directory reuses the previous result.")
+    encoder.add_argument("--jobs", "-j", type=int, default=1,
+                         help="Number of worker processes used to process the blueprints. "
+                              "Use 0 for all CPU cores. (default = %(default)s)")
     encoder.add_argument("source", type=Path,
                          help="A JSON file or a directory with JSON files to encode. Only *.json files are processed.")
     encoder.add_argument("destination", type=Path, nargs="?",
                          help="The destination file to write to. By default, the result "
                               "is copied to clipboard. Use '-' to write to STDOUT.")
 
-    args = parser.parse_args()
-    if args is None:
-        parser.print_help(file=sys.stderr)
-    else:
-        try:
-            args.func(args)
-        except Exception as ex:
-            message = str(ex)
-            if args.verbose or message == "":
-                message += "\n\n" + "".join(format_exception(type(ex), ex, ex.__traceback__))
-            parser.error(message)
+    # Batch
+    batcher = subparsers.add_parser(
+        "batch", formatter_class=argparse.RawTextHelpFormatter,
+        help="Run many decode, dump, or encode jobs in parallel")
+    batcher.set_defaults(func=batch_cmd)
+    batcher.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    batcher.add_argument("--jobs", "-j", type=int, default=None,
+                         help="Number of worker processes. Uses all CPU cores by default.")
+    batcher.add_argument("source", type=Path,
+                         help=textwrap.dedent("""\
+                         A directory with *.txt blueprint strings, or a manifest file.
+                            * directory - decode each *.txt file into the destination directory,
+                                          using the file name without the extension.
+                            * manifest  - a text file with one fatul command per line, e.g.
+                                            decode --sort none my_data my_data.txt
+                                            encode my_data my_data.txt
+                                          Relative paths are resolved from the manifest's directory.
+                                          Jobs are independent, and may run in any order.
+                                          Empty lines and lines starting with # are ignored."""))
+    batcher.add_argument("destination", type=Path, nargs="?",
+                         help="The destination directory when decoding a directory of strings. "
+                              "Defaults to the source directory.")
+
+    # Serve
+    server = subparsers.add_parser(
+        "serve", formatter_class=argparse.RawTextHelpFormatter,
+        help="Run decode, dump, or encode requests read as JSON lines from STDIN",
+        epilog=textwrap.dedent("""\
+        Each request is a JSON object on a single line, using either the command line arguments:
+            {"id": 1, "args": ["decode", "--sort", "none", "my_data", "my_data.txt"]}
+        or the individual parts of the command:
+            {"id": 2, "command": "decode", "options": ["--sort", "none"], "input": "0eNq..."}
+            {"id": 3, "command": "encode", "source": "my_data", "destination": "my_data.txt"}
+        "input" is used as STDIN, and is the default source. The default destination is STDOUT.
+        "cwd" is an optional directory to resolve the relative source and destination paths.
+        Each response is a JSON line with the same "id", "ok" (true or false), "error" message,
+        and the "output" and "messages" that the command wrote to STDOUT and STDERR."""))
+    server.set_defaults(func=serve_cmd)
+    server.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    server.add_argument("--jobs", "-j", type=int, default=1,
+                        help=textwrap.dedent("""\
+                        Number of worker processes handling the requests at the same time.
+                        Use 0 for all CPU cores. With more than one job, responses may be
+                        written in a different order than the requests. (default = %(default)s)"""))
+
+    # Git filter
+    git_filter = subparsers.add_parser(
+        "git-filter", formatter_class=argparse.RawTextHelpFormatter,
+        help="Convert blueprint files as a git long-running clean/smudge filter process",
+        epilog=textwrap.dedent("""\
+        Git starts one fatul process that converts all files using the filter protocol, e.g.
+            git config filter.fatul.process "python3 fatul.py git-filter"
+            git config filter.fatul.required true
+            echo "*.txt filter=fatul" >> .gitattributes
+        Content that is already in the format it is converted to is passed through unchanged.
+        Decoded files are always single JSON files, even for the blueprint books."""))
+    git_filter.set_defaults(func=git_filter_cmd)
+    git_filter.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    git_filter.add_argument("--store", choices=get_args(GitStoreMode), default="decoded",
+                            help=textwrap.dedent("""\
+                            What git stores in the repository - '%(default)s' by default
+                               * decoded - the working tree has blueprint strings, the repository has JSON.
+                               * raw     - the working tree has JSON, the repository has blueprint strings."""))
+    git_filter.add_argument("--ids", choices=get_args(IdsMode), default="refs",
+                            help="How to process the entity_number and entity_id values, "
+                                 "see decode --help. (default = %(default)s)")
+    git_filter.add_argument("--sort", choices=get_args(SortMode), default="all",
+                            help="Order keys and entities in the output, see decode --help. (default = %(default)s)")
+    git_filter.add_argument("--pretty", "-p", dest="compact", default=True, action="store_false",
+                            help="Use standard JSON formatting instead of compact")
+    git_filter.add_argument("--no-shift", dest="normalize_shift", default=True, action="store_false",
+                            help="Do not change entity positions. "
+                                 "If not set, FaTul will attempt to normalize x,y values.")
+
+    # Textconv
+    textconv = subparsers.add_parser(
+        "textconv", formatter_class=argparse.RawTextHelpFormatter,
+        help="Print a blueprint string file as JSON for git diff",
+        epilog=textwrap.dedent("""\
+        Prints the blueprint string decoded with the default decode options (--ids refs --sort all).
+        Files that are not blueprint strings are printed unchanged. Set it up with e.g.
+            git config diff.fatul.textconv "python3 fatul.py textconv"
+            echo "*.txt diff=fatul" >> .gitattributes
+        The results are cached by the git blob hash of the file, so the same content is decoded only once."""))
+    textconv.set_defaults(func=textconv_cmd)
+    textconv.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    textconv.add_argument("--cache-dir", dest="cache_dir", type=Path, default=get_default_cache_dir() / "textconv",
+                          help="Directory to store the decoded results in. (default = %(default)s)")
+    textconv.add_argument("--cache-size", dest="cache_size", type=int, default=TEXTCONV_CACHE_SIZE,
+                          help="Maximum total size of the cached results in bytes. The least recently used "
+                               "results are removed first. Use 0 to disable the cache. (default = %(default)s)")
+    textconv.add_argument("source", type=Path,
+                          help="The file with the Factorio blueprint string. Use '-' to read from STDIN.")
+
+    # Query
+    querier = subparsers.add_parser(
+        "query",
+        help="Find the entities of a blueprint or a blueprint book by area and name, "
+             "and print them as JSON lines")
+    querier.set_defaults(func=query_cmd)
+    querier.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    querier.add_argument("--bbox", type=float, nargs=4, metavar=("X1", "Y1", "X2", "Y2"),
+                         help="Only the entities with the position inside this rectangle, including its edges")
+    querier.add_argument("--radius", type=float, nargs=3, metavar=("X", "Y", "RADIUS"),
+                         help="Only the entities within the radius from the X,Y position")
+    querier.add_argument("--name", dest="names", action="append", metavar="NAME",
+                         help="Only the entities with this name. Can be used multiple times.")
+    querier.add_argument("source", type=Path,
+                         help="A file with a blueprint string or a decoded JSON, or a directory with "
+                              "a decoded blueprint book. Use '-' to read from STDIN. Positions are "
+                              "the original ones, i.e. the decoded positions plus shift_x and shift_y.")
+
+    # Diff
+    differ = subparsers.add_parser(
+        "diff",
+        help="Show the added, removed, moved, and modified entities and wires between two versions "
+             "of a blueprint or a blueprint book")
+    differ.set_defaults(func=diff_cmd)
+    differ.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    differ.add_argument("--json", action="store_true", help="Print the differences as JSON")
+    differ.add_argument("--no-align", dest="align", default=True, action="store_false",
+                        help="Compare the original positions instead of finding the shift that places "
+                             "the most new entities on top of the old ones")
+    differ.add_argument("old", type=Path,
+                        help="A file with a blueprint string or a decoded JSON, or a directory with "
+                             "a decoded blueprint book. Use '-' to read from STDIN.")
+    differ.add_argument("new", type=Path, help="Same as old")
+    return parser
 
 
 def dump_cmd(args: argparse.Namespace):
-    decode(args.source, args.destination, args.verbose, args.compact, sort_mode='keys' if args.sort else 'none')
+    decode(args.source, args.destination, args.verbose, args.compact, sort_mode='keys' if args.sort else 'none',
+           jobs=args.jobs, stream=args.stream, stats_format=args.stats)
 
 
 def decode_cmd(args: argparse.Namespace):
     decode(args.source, args.destination, args.verbose, args.compact, args.sort, args.ids,
-           args.normalize_shift, args.merge_index, args.merge_shift, args.shift_x, args.shift_y)
+           args.normalize_shift, args.merge_index, args.merge_shift, args.shift_x, args.shift_y, args.jobs,
+           args.stream, args.merge_budget, args.incremental, args.stats, args.match_files)
 
 
 def decode(source: Path, destination: Path, verbose: bool, compact: bool,
            sort_mode: SortMode = "none", ids_mode: IdsMode = "keep", normalize_shift=False, merge_index=False,
-           merge_shift=False, override_shift_x: int = None, override_shift_y: int = None) -> None:
+           merge_shift=False, override_shift_x: int = None, override_shift_y: int = None, jobs: int = 1,
+           stream=False, merge_budget: int = MERGE_VOTE_BUDGET, incremental=False,
+           stats_format: Optional[StatsFormat] = None, match_files=False) -> None:
+    if stream and jobs != 1:
+        raise ValueError("Streaming decode processes one book entry at a time, and cannot be used with --jobs")
+    if incremental and str(destination) == "-":
+        raise ValueError("Incremental decode requires a destination directory")
+    processor = Processor(verbose, sort_mode, ids_mode, normalize_shift, compact, merge_index, merge_shift,
+                          (override_shift_x, override_shift_y), jobs, merge_budget, incremental,
+                          Stats(stats_format) if stats_format else None, match_files)
+    if stream and str(destination) != "-":
+        processor.decode_stream(read_source_chunks(source), destination)
+    else:
+        with processor.phase("read"):
+            json_text = "".join(read_source_chunks(source))
+        data = processor.decode(json_text)
+        if str(destination) == "-":
+            with processor.phase("format"):
+                print(to_pretty_json(data, compact))
+        else:
+            processor.write_files(data, destination)
+    if processor.stats is not None:
+        processor.stats.report()
+
+
+def read_source_chunks(source: Optional[Path]) -> Iterator[str]:
+    """Read blueprint string from the clipboard, STDIN, or a file in chunks"""
     if source is None:
         assert_clipboard()
         eprint("Reading blueprint string from clipboard")
         json_text = pyperclip.paste()
+        yield from (json_text[i:i + READ_CHUNK_SIZE] for i in range(0, len(json_text), READ_CHUNK_SIZE))
     elif str(source) == "-":
         eprint("Reading blueprint string from STDIN")
-        json_text = "".join(sys.stdin.readlines())
+        yield from iter(lambda: sys.stdin.read(READ_CHUNK_SIZE), "")
     else:
         if not source.is_file():
             raise ValueError(f"Source file does not exist, or it is not a file: {source}")
         eprint(f"Reading blueprint string from {source}")
-        json_text = source.read_text(encoding="utf8")
-    processor = Processor(verbose, sort_mode, ids_mode, normalize_shift, compact, merge_index, merge_shift,
-                          (override_shift_x, override_shift_y))
-    data = processor.decode(json_text)
-    if str(destination) == "-":
-        print(to_pretty_json(data, compact))
-    else:
-        processor.write_files(data, destination)
+        with source.open(encoding="utf8") as file:
+            yield from iter(lambda: file.read(READ_CHUNK_SIZE), "")
 
 
 def encode_cmd(args: argparse.Namespace):
-    if str(args.source) == "-":
+    encode(args.source, args.destination, args.verbose, args.cache, args.jobs, args.stats)
+
+
+def encode(source: Path, destination: Optional[Path], verbose: bool, cache_path: Optional[Path] = None,
+           jobs: int = 1, stats_format: Optional[StatsFormat] = None) -> None:
+    processor = Processor(verbose, jobs=jobs, stats=Stats(stats_format) if stats_format else None)
+    if cache_path is not None:
+        if not source.is_dir():
+            raise ValueError(f"Cache can only be used when encoding a directory: {source}")
+        eprint(f"Reading json files from directory {source} using cache {cache_path}")
+        cache = EncodeCache(cache_path, source, processor)
+        with processor.phase("read"):
+            data = read_files(source, verbose, cache.load_file)
+        chunks: Iterable[str] = [cache.encode(data)]
+        cache.save()
+    else:
+        with processor.phase("read"):
+            data = read_json_source(source, verbose)
+        chunks = processor.encode_chunks(data)
+    if destination is None:
+        assert_clipboard()
+        pyperclip.copy("".join(chunks))
+        eprint(f"Encoded blueprint string was copied to clipboard.")
+    elif str(destination) == "-":
+        # The result is buffered, so that a failed encoding does not print a partial string
+        sys.stdout.write("".join(chunks) + "\n")
+    else:
+        eprint(f"Writing to {destination}")
+        # The existing file is only replaced once the encoding has succeeded
+        tmp_path = destination.with_name(f"{destination.name}.{os.getpid()}.tmp")
+        try:
+            with tmp_path.open("w", encoding="utf8") as file:
+                file.writelines(chunks)
+            tmp_path.replace(destination)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    if processor.stats is not None:
+        processor.stats.report()
+
+
+def read_json_source(source: Path, verbose: bool) -> Any:
+    if str(source) == "-":
         eprint("Reading json from STDIN")
         data = json.loads("".join(sys.stdin.readlines()))
+    elif source.is_file():
+        eprint(f"Reading a json file from {source}")
+        data = json.loads(source.read_text(encoding="utf8"))
+    elif source.is_dir():
+        eprint(f"Reading json files from directory {source}")
+        data = read_files(source, verbose)
+    else:
+        raise ValueError(f"Invalid source file or directory: {source}")
+    return data
+
+
+@dataclass(frozen=True)
+class Options:
+    """Immutable decoding options of the library API. The defaults are the same as the decode command's.
+    See `fatul.py decode --help` for the meaning of each option."""
+    sort_mode: SortMode = "all"
+    ids_mode: IdsMode = "refs"
+    normalize_shift: bool = True
+    compact: bool = True
+    merge_index: bool = True
+    merge_shift: bool = True
+    override_shift_x: Optional[int] = None
+    override_shift_y: Optional[int] = None
+    merge_budget: int = MERGE_VOTE_BUDGET
+    match_files: bool = False
+    jobs: int = 1
+    verbose: bool = False
+
+    def create_processor(self) -> "Processor":
+        return Processor(self.verbose, self.sort_mode, self.ids_mode, self.normalize_shift, self.compact,
+                         self.merge_index, self.merge_shift, (self.override_shift_x, self.override_shift_y),
+                         self.jobs, self.merge_budget, match_files=self.match_files)
+
+
+DEFAULT_OPTIONS = Options()
+
+
+@contextmanager
+def _log_to(log: Optional[Callable[[str], None]]):
+    token = _log_callback.set(logger.info if log is None else log)
+    try:
+        yield
+    finally:
+        _log_callback.reset(token)
+
+
+# Library API - these functions can be called concurrently from multiple threads.
+# They do not access the clipboard, STDIN or STDOUT, and pass their messages to the log callback,
+# or to the "fatul" logger at the INFO level if it is not given.
+
+def decode_string(blueprint_string: str, options: Options = DEFAULT_OPTIONS,
+                  log: Optional[Callable[[str], None]] = None) -> dict:
+    """Decode a blueprint string, and process it the same way as the decode command"""
+    with _log_to(log):
+        return options.create_processor().decode(blueprint_string.strip())
+
+
+def encode_data(data: dict, log: Optional[Callable[[str], None]] = None) -> str:
+    """Encode data returned by decode_string() or read_tree() into a blueprint string.
+    The data is modified in place, e.g. the entity numbers are re-created."""
+    with _log_to(log):
+        return Processor(False).encode(data)
+
+
+def write_tree(data: dict, destination: Union[Path, str], options: Options = DEFAULT_OPTIONS,
+               log: Optional[Callable[[str], None]] = None) -> None:
+    """Write data returned by decode_string() to a JSON file, or a blueprint book to a directory,
+    merging it with the existing files the same way as the decode command. The data is modified in place."""
+    with _log_to(log):
+        options.create_processor().write_files(data, Path(destination))
+
+
+def read_tree(source: Union[Path, str], log: Optional[Callable[[str], None]] = None) -> dict:
+    """Read a JSON file, or a directory written by write_tree() or the decode command"""
+    source = Path(source)
+    with _log_to(log):
+        if source.is_dir():
+            return read_files(source, False)
+        if source.is_file():
+            return json.loads(source.read_text(encoding="utf8"))
+        raise ValueError(f"Invalid source file or directory: {source}")
+
+
+def query_cmd(args: argparse.Namespace):
+    if args.bbox is None and args.radius is None and not args.names:
+        raise ValueError("At least one of --bbox, --radius, or --name is required")
+    data = read_blueprint_source(args.source, args.verbose)
+    count = 0
+    for label, blueprint in iter_blueprints(data):
+        index = SpatialIndex.from_blueprint(blueprint)
+        for idx in index.query(args.bbox, args.radius, args.names):
+            x, y = index.positions[idx]
+            print(to_json(dict(blueprint=label, name=index.entities[idx].get("name"), position=dict(x=x, y=y))))
+            count += 1
+    eprint(f"Found {count} entities")
+
+
+def diff_cmd(args: argparse.Namespace):
+    old_data = read_blueprint_source(args.old, args.verbose)
+    new_data = read_blueprint_source(args.new, args.verbose)
+    result = diff_data(old_data, new_data, args.align)
+    if args.json:
+        print(to_pretty_json(result))
+    else:
+        print_diff(result)
+
+
+def diff_data(old_data: dict, new_data: dict, align: bool = True) -> dict:
+    """Compare all blueprints of two blueprints or books. Book entries are paired by their labels and order."""
+    old_blueprints = list(iter_blueprints(old_data))
+    new_blueprints = list(iter_blueprints(new_data))
+    if "blueprint" in old_data and "blueprint" in new_data:
+        # Two blueprints are always compared, even if they have different labels
+        pairs = [(old_blueprints[0], new_blueprints[0])]
+        unpaired = []
+    else:
+        new_by_label: Dict[str, List[Tuple[str, dict]]] = {}
+        for entry in new_blueprints:
+            new_by_label.setdefault(entry[0], []).append(entry)
+        pairs = [(entry, new_by_label[entry[0]].pop(0) if new_by_label.get(entry[0]) else None)
+                 for entry in old_blueprints]
+        unpaired = [entry for entries in new_by_label.values() for entry in entries]
+    results = []
+    for (label, old_bp), new_entry in pairs:
+        if new_entry is None:
+            results.append(dict(label=label, status="removed"))
+        else:
+            results.append(BlueprintDiff(old_bp, new_entry[1], align).get_result(label))
+    results.extend(dict(label=label, status="added") for label, _ in unpaired)
+    return dict(blueprints=results)
+
+
+def print_diff(result: dict) -> None:
+    def fmt(pos: dict) -> str:
+        return f"({pos['x']}, {pos['y']})"
+
+    def fmt_wire_end(end: dict) -> str:
+        return f"{end['name']} {fmt(end['position'])}" + (f":{end['connector']}" if end["connector"] else "")
+
+    def fmt_wire(wire: dict) -> str:
+        typ = "wire" if wire["type"] == "wire" else f"{wire['type']} wire"
+        return f"{typ} {fmt_wire_end(wire['from'])} - {fmt_wire_end(wire['to'])}"
+
+    for bp in result["blueprints"]:
+        if bp["status"] != "changed":
+            print(f"{bp['label']}: {bp['status']}")
+            continue
+        moved_by = bp.get("moved_by")
+        print(f"{bp['label']}:" + (f" moved by x={moved_by['x']}, y={moved_by['y']}" if moved_by else ""))
+        for v in bp["removed"]:
+            print(f"  - {v['name']} {fmt(v['position'])}")
+        for v in bp["added"]:
+            print(f"  + {v['name']} {fmt(v['position'])}")
+        for v in bp["moved"]:
+            print(f"  > {v['name']} {fmt(v['from'])} -> {fmt(v['to'])}")
+        for v in bp["modified"]:
+            print(f"  ~ {v['name']} {fmt(v['position'])}: {', '.join(v['keys'])}")
+        for v in bp["wires_removed"]:
+            print(f"  - {fmt_wire(v)}")
+        for v in bp["wires_added"]:
+            print(f"  + {fmt_wire(v)}")
+
+
+class BlueprintDiff:
+    """Entity-level differences between two versions of a blueprint.
+    The new entities are first aligned with the old ones using the same voting as the decode shift merging,
+    and then matched by their name and position. The rest are matched by their content hash as moved entities.
+    Positions are compared as integers in the old blueprint's coordinates."""
+
+    def __init__(self, old_bp: dict, new_bp: dict, align: bool):
+        self.old_bp = old_bp
+        self.new_bp = new_bp
+        self.old_entities: List[dict] = old_bp.get("entities", [])
+        self.new_entities: List[dict] = new_bp.get("entities", [])
+        self.old_shift = (coord_to_int(old_bp.get("shift_x", 0)), coord_to_int(old_bp.get("shift_y", 0)))
+        self.new_shift = (coord_to_int(new_bp.get("shift_x", 0)), coord_to_int(new_bp.get("shift_y", 0)))
+        # Added to the new positions to get the old blueprint's coordinates. By default, the original positions
+        # (the decoded positions plus the shift) are the same.
+        self.offset = (self.new_shift[0] - self.old_shift[0], self.new_shift[1] - self.old_shift[1])
+        if align and self.old_entities and self.new_entities:
+            processor = Processor(False)
+            new_blueprint = Blueprint(processor, {"blueprint": new_bp}, False)
+            shift = new_blueprint.calc_offset_by_votes(Blueprint(processor, {"blueprint": old_bp}, False))
+            if shift is not None:
+                self.offset = (-shift[0] * COORD_MULTIPLIER, -shift[1] * COORD_MULTIPLIER)
+        self.old_positions = [get_int_position(v) for v in self.old_entities]
+        self.new_positions = [(x + self.offset[0], y + self.offset[1])
+                              for x, y in (get_int_position(v) for v in self.new_entities)]
+        # Pairs of the old and new entity indexes with the same name and position
+        self.matched: List[Tuple[int, int]] = []
+        self.new_key_to_idx: Dict[int, int] = {}
+
+    def get_result(self, label: str) -> dict:
+        added, removed, moved, modified = self.match_entities()
+        # Wire ends are identified by the old entity index, or by the new one after all old entities,
+        # so that the wires of the moved entities are not reported as changed
+        old_count = len(self.old_entities)
+        new_keys = list(range(old_count, old_count + len(self.new_entities)))
+        for old, new in self.matched + moved:
+            new_keys[new] = old
+        self.new_key_to_idx = {key: idx for idx, key in enumerate(new_keys)}
+        old_wires = self.get_wires(self.old_bp, self.old_entities, self.old_positions, list(range(old_count)))
+        new_wires = self.get_wires(self.new_bp, self.new_entities, self.new_positions, new_keys)
+        result = dict(label=label, status="changed")
+        # How much the unchanged entities have moved in the original coordinates
+        moved_x = self.new_shift[0] - self.old_shift[0] - self.offset[0]
+        moved_y = self.new_shift[1] - self.old_shift[1] - self.offset[1]
+        if moved_x != 0 or moved_y != 0:
+            result["moved_by"] = dict(x=int_to_coord(moved_x), y=int_to_coord(moved_y))
+        result["added"] = [self.describe(self.new_entities[v], self.new_positions[v], False) for v in added]
+        result["removed"] = [self.describe(self.old_entities[v], self.old_positions[v], True) for v in removed]
+        result["moved"] = [dict(name=self.old_entities[old]["name"],
+                                **{"from": self.to_position(self.old_positions[old], True),
+                                   "to": self.to_position(self.new_positions[new], False)}) for old, new in moved]
+        result["modified"] = [dict(self.describe(self.new_entities[new], self.new_positions[new], False), keys=keys)
+                              for old, new, keys in modified]
+        result["wires_added"] = [self.describe_wire(v, False) for v in sorted(new_wires - old_wires)]
+        result["wires_removed"] = [self.describe_wire(v, True) for v in sorted(old_wires - new_wires)]
+        if not any(result[k] for k in ("added", "removed", "moved", "modified", "wires_added", "wires_removed")):
+            result["status"] = "unchanged"
+        return result
+
+    def match_entities(self) -> Tuple[List[int], List[int], List[Tuple[int, int]], List[Tuple[int, int, List[str]]]]:
+        old_by_key: Dict[Tuple[str, int, int], List[int]] = {}
+        for idx, entity in enumerate(self.old_entities):
+            old_by_key.setdefault((entity["name"], *self.old_positions[idx]), []).append(idx)
+        new_unmatched = []
+        modified = []
+        for idx, entity in enumerate(self.new_entities):
+            candidates = old_by_key.get((entity["name"], *self.new_positions[idx]))
+            if not candidates:
+                new_unmatched.append(idx)
+                continue
+            # Stacked entities are matched by their content first
+            content = get_diff_content(entity)
+            old_idx = next((v for v in candidates if get_diff_content(self.old_entities[v]) == content), None)
+            if old_idx is None:
+                old_idx = candidates[0]
+                old_content = get_diff_content(self.old_entities[old_idx])
+                keys = sorted(k for k in old_content.keys() | content.keys() if old_content.get(k) != content.get(k))
+                modified.append((old_idx, idx, keys))
+            candidates.remove(old_idx)
+            self.matched.append((old_idx, idx))
+        old_unmatched = sorted(v for values in old_by_key.values() for v in values)
+        # Entities that only changed their position have the same name and hash
+        old_by_hash: Dict[Tuple[str, str], List[int]] = {}
+        for idx in old_unmatched:
+            entity = self.old_entities[idx]
+            old_by_hash.setdefault((entity["name"], get_obj_hash(entity)), []).append(idx)
+        added = []
+        moved = []
+        for idx in new_unmatched:
+            entity = self.new_entities[idx]
+            candidates = old_by_hash.get((entity["name"], get_obj_hash(entity)))
+            if candidates:
+                moved.append((candidates.pop(0), idx))
+            else:
+                added.append(idx)
+        removed = sorted(v for values in old_by_hash.values() for v in values)
+        return added, removed, moved, modified
+
+    @staticmethod
+    def get_wires(blueprint: dict, entities: List[dict], positions: List[Tuple[int, int]],
+                  keys: List[int]) -> Set[tuple]:
+        """Get all wires as (type, (key, connector), (key, connector)) tuples with the sorted ends.
+        References can be either entity IDs or the relative IDs of the decoded blueprints."""
+        keys_by_id = {v["entity_number"]: key for v, key in zip(entities, keys) if "entity_number" in v}
+        keys_by_pos: Dict[Tuple[int, int], int] = {}
+        for pos, key in zip(positions, keys):
+            keys_by_pos.setdefault(pos, key)
+
+        def resolve(ref: Union[int, str], from_pos: Tuple[int, int], entity: Optional[dict]) -> Optional[int]:
+            if type(ref) == int:
+                return keys_by_id.get(ref)
+            try:
+                offset = parse_rel_offset(ref) if type(ref) == str else None
+            except ValueError as ex:
+                extra = to_json(entity) if entity is not None else "wires"
+                eprint(f"Warning: ignoring the connection, {ex}:\n{extra}")
+                return None
+            if offset is None:
+                return None
+            x_diff, y_diff = unpack_position(offset[0])
+            return keys_by_pos.get((from_pos[0] + x_diff, from_pos[1] + y_diff))
+
+        wires = set()
+
+        def add_wire(typ: str, from_key, from_connector, to_key, to_connector) -> None:
+            if from_key is not None and to_key is not None:
+                wires.add((typ, *sorted([(from_key, str(from_connector)), (to_key, str(to_connector))])))
+
+        for entity, pos, key in zip(entities, positions, keys):
+            for connector, value in (entity.get("connections") or {}).items():
+                if type(value) == dict:
+                    for color, targets in value.items():
+                        for target in targets:
+                            to_key = resolve(target.get("entity_id", target.get("entity_rel")), pos, entity)
+                            add_wire(color, key, connector, to_key, target.get("circuit_id", 1))
+                elif type(value) == list:
+                    for target in value:
+                        to_key = resolve(target.get("entity_id", target.get("entity_rel")), pos, entity)
+                        add_wire("copper", key, connector, to_key, f"Cu{target.get('wire_id', 0)}")
+            for ref in entity.get("neighbours") or []:
+                add_wire("copper", key, "", resolve(ref, pos, entity), "")
+        if blueprint.get("wires"):
+            # Relative IDs of the wires are relative to the minimum x and y of all entities
+            min_pos = (min((v[0] for v in positions), default=0), min((v[1] for v in positions), default=0))
+            for wire in blueprint["wires"]:
+                add_wire("wire", resolve(wire[0], min_pos, None), wire[1], resolve(wire[2], min_pos, None), wire[3])
+        return wires
+
+    def to_position(self, pos: Tuple[int, int], is_old: bool) -> dict:
+        """Convert the compared position back to the original position of the old or the new blueprint"""
+        if is_old:
+            x, y = pos[0] + self.old_shift[0], pos[1] + self.old_shift[1]
+        else:
+            x = pos[0] - self.offset[0] + self.new_shift[0]
+            y = pos[1] - self.offset[1] + self.new_shift[1]
+        return dict(x=int_to_coord(x), y=int_to_coord(y))
+
+    def describe(self, entity: dict, pos: Tuple[int, int], is_old: bool) -> dict:
+        return dict(name=entity["name"], position=self.to_position(pos, is_old))
+
+    def describe_wire(self, wire: tuple, is_old: bool) -> dict:
+        typ, (key1, connector1), (key2, connector2) = wire
+        return dict(type=typ, **{"from": dict(self.describe_wire_end(key1, is_old), connector=connector1),
+                                 "to": dict(self.describe_wire_end(key2, is_old), connector=connector2)})
+
+    def describe_wire_end(self, key: int, is_old: bool) -> dict:
+        if is_old:
+            return self.describe(self.old_entities[key], self.old_positions[key], True)
+        idx = self.new_key_to_idx[key]
+        return self.describe(self.new_entities[idx], self.new_positions[idx], False)
+
+
+def get_int_position(entity: dict) -> Tuple[int, int]:
+    position = entity["position"]
+    return coord_to_int(position["x"]), coord_to_int(position["y"])
+
+
+def get_diff_content(entity: dict) -> dict:
+    """Entity values that are compared by the diff, ignoring the positions and the references"""
+    return {k: v for k, v in entity.items() if k not in HASH_VOLATILE_KEYS}
+
+
+def read_blueprint_source(source: Path, verbose: bool) -> dict:
+    """Read a blueprint string, a JSON file, or a directory with JSON files without processing them"""
+    if source.is_dir():
+        return read_json_source(source, verbose)
+    if str(source) == "-":
+        eprint("Reading from STDIN")
+        text = sys.stdin.read()
+    elif source.is_file():
+        eprint(f"Reading {source}")
+        text = source.read_text(encoding="utf8")
+    else:
+        raise ValueError(f"Invalid source file or directory: {source}")
+    text = text.strip()
+    if text.startswith("{"):
+        return json.loads(text)
+    return Processor(verbose).decode(text)
+
+
+def iter_blueprints(data: Any, path: str = "") -> Iterator[Tuple[str, dict]]:
+    """Find all blueprints, and return them with their labels prefixed by the labels of their books"""
+    if type(data) != dict:
+        return
+    if "blueprint" in data:
+        yield path + get_label(data), data["blueprint"]
+    elif "blueprint_book" in data:
+        path += get_label(data) + "/"
+        for entry in data["blueprint_book"].get("blueprints", []):
+            yield from iter_blueprints(entry, path)
+
+
+class SpatialIndex:
+    """Entities of a blueprint grouped by the square grid cells of their positions,
+    to find the entities in an area without checking all of them."""
+
+    def __init__(self, entities: List[dict], shift_x: Union[int, float] = 0, shift_y: Union[int, float] = 0,
+                 cell_size: int = SPATIAL_CELL_SIZE):
+        self.entities = entities
+        self.cell_size = cell_size
+        self.positions: List[Tuple[Union[int, float], Union[int, float]]] = []
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        self.names: Dict[str, List[int]] = {}
+        for idx, entity in enumerate(entities):
+            position = entity["position"]
+            x, y = position["x"] + shift_x, position["y"] + shift_y
+            self.positions.append((x, y))
+            self.cells.setdefault((int(x // cell_size), int(y // cell_size)), []).append(idx)
+            self.names.setdefault(entity.get("name"), []).append(idx)
+
+    @staticmethod
+    def from_blueprint(blueprint: dict) -> "SpatialIndex":
+        """Index the entities using their original positions, i.e. including the shift of a decoded blueprint"""
+        return SpatialIndex(blueprint.get("entities", []), blueprint.get("shift_x", 0), blueprint.get("shift_y", 0))
+
+    def query(self, bbox: Optional[Iterable[float]] = None, circle: Optional[Iterable[float]] = None,
+              names: Optional[Iterable[str]] = None) -> List[int]:
+        """Get the indexes of the entities inside the (x1, y1, x2, y2) bbox, within the (x, y, radius) circle,
+        and with one of the names, in their original order. Each filter is optional."""
+        area = None
+        if bbox is not None:
+            x1, y1, x2, y2 = bbox
+            area = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        if circle is not None:
+            cx, cy, radius = circle
+            circle_area = (cx - radius, cy - radius, cx + radius, cy + radius)
+            if area is None:
+                area = circle_area
+            else:
+                area = (max(area[0], circle_area[0]), max(area[1], circle_area[1]),
+                        min(area[2], circle_area[2]), min(area[3], circle_area[3]))
+        names = None if names is None else set(names)
+        if area is None:
+            candidates = range(len(self.entities)) if names is None else \
+                chain.from_iterable(self.names.get(v, []) for v in names)
+        elif area[0] > area[2] or area[1] > area[3]:
+            return []
+        else:
+            candidates = self.get_area_candidates(*area)
+        result = []
+        for idx in candidates:
+            x, y = self.positions[idx]
+            if area is not None and not (area[0] <= x <= area[2] and area[1] <= y <= area[3]):
+                continue
+            if circle is not None and (x - cx) ** 2 + (y - cy) ** 2 > radius ** 2:
+                continue
+            if names is not None and self.entities[idx].get("name") not in names:
+                continue
+            result.append(idx)
+        result.sort()
+        return result
+
+    def get_area_candidates(self, x1: float, y1: float, x2: float, y2: float) -> Iterator[int]:
+        """Get the entities in all grid cells that overlap the area"""
+        size = self.cell_size
+        cx1, cy1, cx2, cy2 = int(x1 // size), int(y1 // size), int(x2 // size), int(y2 // size)
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.cells):
+            # The area is larger than the blueprint, so it is faster to check every non-empty cell
+            cells = (v for (cx, cy), v in self.cells.items() if cx1 <= cx <= cx2 and cy1 <= cy <= cy2)
+        else:
+            cells = (self.cells[k] for k in ((cx, cy) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1))
+                     if k in self.cells)
+        return chain.from_iterable(cells)
+
+
+def batch_cmd(args: argparse.Namespace):
+    if args.source.is_dir():
+        dest_dir = args.source if args.destination is None else args.destination
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        jobs = [BatchJob(["decode", str(dest_dir / path.stem), str(path)])
+                for path in sorted(args.source.glob("*.txt"))]
     elif args.source.is_file():
-        eprint(f"Reading a json file from {args.source}")
-        data = json.loads(args.source.read_text(encoding="utf8"))
-    elif args.source.is_dir():
-        eprint(f"Reading json files from directory {args.source}")
-        data = read_files(args.source, args.verbose)
+        if args.destination is not None:
+            raise ValueError("Destination cannot be used together with a manifest file")
+        jobs = read_batch_manifest(args.source)
     else:
         raise ValueError(f"Invalid source file or directory: {args.source}")
-    processor = Processor(args.verbose)
-    encoded = processor.encode(data)
-    if args.destination is None:
-        assert_clipboard()
-        pyperclip.copy(encoded)
-        eprint(f"Encoded blueprint string was copied to clipboard.")
-    elif str(args.destination) == "-":
-        print(encoded)
-    else:
-        eprint(f"Writing to {args.destination}")
-        args.destination.write_text(encoded, "utf8")
+    if not jobs:
+        raise ValueError(f"No batch jobs found in {args.source}")
+    if args.verbose:
+        eprint(f"Running {len(jobs)} batch jobs")
+
+    failed = 0
+    executor = None if args.jobs == 1 else ProcessPoolExecutor(max_workers=None if args.jobs == 0 else args.jobs)
+    try:
+        if executor is None:
+            results = (run_batch_job(job) for job in jobs)
+        else:
+            results = (f.result() for f in as_completed([executor.submit(run_batch_job, job) for job in jobs]))
+        for job, error in results:
+            if error is None:
+                eprint(f"OK     {shlex.join(job.argv)}")
+            else:
+                failed += 1
+                eprint(f"FAILED {shlex.join(job.argv)}\n{textwrap.indent(error, '       ')}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if failed:
+        raise ValueError(f"{failed} of {len(jobs)} batch jobs failed")
+    eprint(f"All {len(jobs)} batch jobs succeeded")
+
+
+def read_batch_manifest(path: Path) -> List["BatchJob"]:
+    jobs = []
+    parser = make_parser()
+    for line_no, line in enumerate(path.read_text(encoding="utf8").splitlines(), 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(f"Unable to parse {path}:{line_no}: {line}")
+        if args.func not in (decode_cmd, dump_cmd, encode_cmd):
+            raise ValueError(f"Only decode, dump, and encode commands are allowed in {path}:{line_no}: {line}")
+        if args.source is None or args.destination is None or "-" in (str(args.source), str(args.destination)):
+            raise ValueError(f"Batch jobs must have both source and destination files in {path}:{line_no}: {line}")
+        jobs.append(BatchJob(argv, path.parent))
+    return jobs
+
+
+@dataclass
+class BatchJob:
+    argv: List[str]
+    # Relative source and destination paths are resolved from this directory
+    base_dir: Optional[Path] = None
+
+
+def run_batch_job(job: BatchJob) -> Tuple[BatchJob, Optional[str]]:
+    """Run a single decode/dump/encode command, and return it with an error message if it failed.
+    This is a top level function so that it can be used by the worker processes."""
+    try:
+        try:
+            args = make_parser().parse_args(job.argv)
+        except SystemExit:
+            raise ValueError("Unable to parse command arguments")
+        if job.base_dir is not None:
+            # STDIN, STDOUT, and clipboard are not paths
+            if args.source is not None and str(args.source) != "-":
+                args.source = job.base_dir / args.source
+            if args.destination is not None and str(args.destination) != "-":
+                args.destination = job.base_dir / args.destination
+            if getattr(args, "cache", None) is not None:
+                args.cache = job.base_dir / args.cache
+        args.func(args)
+        return job, None
+    except Exception as ex:
+        message = str(ex)
+        if message == "":
+            message = "".join(format_exception(type(ex), ex, ex.__traceback__))
+        return job, message
+
+
+def serve_cmd(args: argparse.Namespace):
+    out = sys.stdout
+    lock = threading.Lock()
+
+    def respond(response: dict) -> None:
+        with lock:
+            out.write(json.dumps(response, ensure_ascii=False) + "\n")
+            out.flush()
+
+    def done(future: Future, line: str) -> None:
+        # The worker process itself may fail, e.g. if it is killed, but the client still needs a response
+        ex = future.exception()
+        if ex is None:
+            respond(future.result())
+        else:
+            respond(dict(id=get_serve_request_id(line), ok=False, error=str(ex) or type(ex).__name__, output="",
+                         messages=""))
+
+    executor = None if args.jobs == 1 else ProcessPoolExecutor(max_workers=None if args.jobs == 0 else args.jobs)
+    if args.verbose:
+        eprint("Waiting for requests on STDIN")
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            if executor is None:
+                respond(run_serve_request(line))
+            else:
+                executor.submit(run_serve_request, line).add_done_callback(lambda f, line=line: done(f, line))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def run_serve_request(line: str) -> dict:
+    """Run a single serve request, capturing everything the command writes to STDOUT and STDERR.
+    This is a top level function so that it can be used by the worker processes."""
+    request_id = None
+    output = io.StringIO()
+    messages = io.StringIO()
+    try:
+        request = json.loads(line)
+        if type(request) != dict:
+            raise ValueError("Request must be a JSON object")
+        request_id = request.get("id")
+        argv = get_serve_request_argv(request)
+        cwd = request.get("cwd")
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(request.get("input", ""))
+        # The clipboard of the server is never used, even if the args do not have a source or a destination
+        token = _clipboard_disabled.set(True)
+        try:
+            with redirect_stdout(output), redirect_stderr(messages):
+                _, error = run_batch_job(BatchJob(argv, None if cwd is None else Path(cwd)))
+        finally:
+            _clipboard_disabled.reset(token)
+            sys.stdin = stdin
+    except Exception as ex:
+        error = str(ex) or type(ex).__name__
+    return dict(id=request_id, ok=error is None, error=error, output=output.getvalue(), messages=messages.getvalue())
+
+
+def get_serve_request_id(line: str) -> Any:
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    return request.get("id") if type(request) == dict else None
+
+
+def get_serve_request_argv(request: dict) -> List[str]:
+    for key in ("cwd", "input", "source", "destination"):
+        if key in request and type(request[key]) != str:
+            raise ValueError(f"Request {key} must be a string")
+    argv = request.get("args")
+    if argv is None:
+        command = request.get("command")
+        options = request.get("options", [])
+        if type(options) != list or not all(type(v) == str for v in options):
+            raise ValueError("Request options must be a list of strings")
+        if command in ("decode", "d", "dump", "encode", "e") and "source" not in request and "input" not in request:
+            raise ValueError("Request must have a source or an input")
+        source = request.get("source", "-")
+        destination = request.get("destination", "-")
+        if command in ("decode", "d", "dump"):
+            argv = [command, *options, destination, source]
+        elif command in ("encode", "e"):
+            argv = [command, *options, source, destination]
+        else:
+            argv = [command]
+    if type(argv) != list or not argv or not all(type(v) == str for v in argv):
+        raise ValueError("Request must have an args list of strings, or a command")
+    if argv[0] not in ("decode", "d", "dump", "encode", "e"):
+        raise ValueError(f"Only decode, dump, and encode commands are allowed, not {argv[0]}")
+    return argv
+
+
+def git_filter_cmd(args: argparse.Namespace):
+    decoder = Processor(args.verbose, args.sort, args.ids, args.normalize_shift, args.compact)
+    GitFilter(decoder, Processor(args.verbose), args.store, sys.stdin.buffer, sys.stdout.buffer).run()
+
+
+class GitFilter:
+    """Git long-running filter process, see https://git-scm.com/docs/gitattributes#_long_running_filter_process
+    Every packet has a 4-digit hex length header that includes its own size, and "0000" is a flush packet."""
+
+    def __init__(self, decoder: "Processor", encoder: "Processor", store: GitStoreMode, reader: BinaryIO,
+                 writer: BinaryIO):
+        self.decoder = decoder
+        self.encoder = encoder
+        self.store = store
+        self.reader = reader
+        self.writer = writer
+
+    def run(self) -> None:
+        self.handshake()
+        while True:
+            try:
+                headers = self.read_text_list()
+            except EOFError:
+                # Git closes the pipe when it has no more files to convert
+                return
+            request = dict(line.split("=", 1) for line in headers if "=" in line)
+            content = self.read_content()
+            command = request.get("command")
+            pathname = request.get("pathname")
+            try:
+                result = self.convert(command, content)
+            except Exception as ex:
+                eprint(f"Unable to {command} {pathname}: {ex}")
+                self.write_text_list(["status=error"])
+                continue
+            if self.decoder.verbose:
+                eprint(f"Converted {pathname} with {command}")
+            self.write_text_list(["status=success"])
+            self.write_content(result)
+            # An empty list keeps the success status
+            self.write_text_list([])
+
+    def handshake(self) -> None:
+        welcome = self.read_text_list()
+        if not welcome or welcome[0] != "git-filter-client" or "version=2" not in welcome:
+            raise ValueError(f"Unsupported git filter protocol: {welcome}")
+        self.write_text_list(["git-filter-server", "version=2"])
+        capabilities = self.read_text_list()
+        self.write_text_list([v for v in ("capability=clean", "capability=smudge") if v in capabilities])
+
+    def convert(self, command: str, content: bytes) -> bytes:
+        if command not in ("clean", "smudge"):
+            raise ValueError(f"Unsupported command {command}")
+        text = content.decode("utf8").strip()
+        # Clean converts the working tree file into the content stored in the repository, smudge does the reverse
+        if (command == "clean") == (self.store == "decoded"):
+            if text == "" or text.startswith("{"):
+                return content
+            data = self.decoder.decode(text)
+            return (to_pretty_json(data, self.decoder.compact) + "\n").encode("utf8")
+        if text == "" or text.startswith("0"):
+            return content
+        return (self.encoder.encode(json.loads(text)) + "\n").encode("utf8")
+
+    def read_packet(self) -> Optional[bytes]:
+        """Read a single packet, and return its data or None for the flush packet"""
+        header = self.reader.read(4)
+        if not header:
+            raise EOFError()
+        if len(header) != 4:
+            raise ValueError("Unexpected end of the git filter input")
+        size = int(header, 16)
+        if size == 0:
+            return None
+        if size <= 4:
+            raise ValueError(f"Unexpected git filter packet {header}")
+        data = self.reader.read(size - 4)
+        if len(data) != size - 4:
+            raise ValueError("Unexpected end of the git filter input")
+        return data
+
+    def read_text_list(self) -> List[str]:
+        result = []
+        while (data := self.read_packet()) is not None:
+            result.append(data.decode("utf8").rstrip("\n"))
+        return result
+
+    def read_content(self) -> bytes:
+        result = []
+        while (data := self.read_packet()) is not None:
+            result.append(data)
+        return b"".join(result)
+
+    def write_packet(self, data: Optional[bytes]) -> None:
+        self.writer.write(b"0000" if data is None else b"%04x" % (len(data) + 4) + data)
+
+    def write_text_list(self, lines: List[str]) -> None:
+        for line in lines:
+            self.write_packet(f"{line}\n".encode("utf8"))
+        self.write_packet(None)
+        self.writer.flush()
+
+    def write_content(self, content: bytes) -> None:
+        for i in range(0, len(content), PKT_LINE_MAX_DATA):
+            self.write_packet(content[i:i + PKT_LINE_MAX_DATA])
+        self.write_packet(None)
+        self.writer.flush()
+
+
+def textconv_cmd(args: argparse.Namespace):
+    content = sys.stdin.buffer.read() if str(args.source) == "-" else args.source.read_bytes()
+    cache = TextconvCache(args.cache_dir, args.cache_size) if args.cache_size > 0 else None
+    sys.stdout.write(textconv(content, cache, args.verbose))
+
+
+def textconv(content: bytes, cache: Optional["TextconvCache"], verbose: bool) -> str:
+    text = content.decode("utf8")
+    if not text.strip().startswith("0"):
+        return text
+    # Same as the id git uses for the blob with this content
+    key = hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+    result = None if cache is None else cache.get(key)
+    if result is not None:
+        if verbose:
+            eprint(f"Using cached result of blob {key}")
+        return result
+    try:
+        data = Processor(verbose, "all", "refs", normalize_shift=True, compact=True).decode(text.strip())
+    except (ValueError, KeyError, TypeError, AttributeError, zlib.error) as ex:
+        # Not every file that starts with 0 is a blueprint string, show such files as they are
+        if verbose:
+            eprint(f"Unable to decode blob {key}, showing it as is: {ex}")
+        return text
+    result = to_pretty_json(data) + "\n"
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+class TextconvCache:
+    """Decoded blueprint strings stored as one file per git blob hash.
+    The modification time of a file is updated when it is used, and the oldest files are removed
+    when the total size exceeds the limit."""
+
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+
+    def get_path(self, key: str) -> Path:
+        return self.path / f"{key}-{TEXTCONV_CACHE_VERSION}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.get_path(key)
+        try:
+            result = path.read_text(encoding="utf8")
+            os.utime(path)
+        except FileNotFoundError:
+            # Another process may have removed it in the meantime
+            return None
+        return result
+
+    def put(self, key: str, text: str) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(key)
+        # Several git processes may run at the same time, so write to a unique temporary file first
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(text, "utf8")
+        tmp_path.replace(path)
+        self.evict()
+
+    def evict(self) -> None:
+        files = []
+        total_size = 0
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                    total_size += stat.st_size
+        if total_size <= self.max_size:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def get_default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    return (Path(cache_home) if cache_home else Path.home() / ".cache") / "fatul"
 
 
 def get_non_index_key(data):
@@ -232,156 +1379,595 @@ def get_non_index_key(data):
     return keys.pop()
 
 
-def read_files(dir_path: Path, verbose: bool) -> dict:
-    # Recursively reads a directory of JSON files and returns a dict with the blueprint book
+def read_files(dir_path: Path, verbose: bool, load_file: Callable[[Path], Any] = None) -> dict:
+    # Recursively reads a directory of JSON files and returns a dict with the blueprint book.
+    # If given, load_file() is used to load each JSON file except for the metadata.
+    # Files are read and parsed by a thread pool, and each book's entries are sorted once all of them are loaded.
+    if load_file is None:
+        load_file = lambda path: read_json_file(path, verbose)
+    books = []
+    with ThreadPoolExecutor() as executor:
+        data = _read_files_rec(dir_path, lambda path: executor.submit(load_file, path), books)
+        for blueprints in books:
+            blueprints[:] = [v.result() if type(v) == Future else v for v in blueprints]
+            blueprints.sort(key=lambda v: v.index if type(v) == EncodedJson else v.get("index", 0))
+    return data
+
+
+def _read_files_rec(dir_path: Path, load_file: Callable[[Path], Future], books: List[list]) -> dict:
     metadata_path = dir_path / "_metadata.json"
     if not metadata_path.is_file():
         raise ValueError(f"Missing metadata file: {metadata_path}")
     data = json.loads(metadata_path.read_text(encoding="utf8"))
     assert type(data) == dict
     blueprints = []
+    books.append(blueprints)
     key = get_non_index_key(data)
     # Factorio orders blueprints before the rest of the keys
     data[key] = {"blueprints": blueprints, **data[key]}
-    for path in dir_path.iterdir():
-        if path.is_dir():
-            blueprints.append(read_files(path, verbose))
-        elif path.is_file():
-            if path.suffix != ".json":
-                eprint(f"Ignoring non-json file: {path}")
-                continue
-            if path.name == "_metadata.json":
-                continue
-            if verbose:
-                eprint(f"Loading {path}")
-            blueprints.append(json.loads(path.read_text(encoding="utf8")))
-        else:
-            eprint(f"Skipping unrecognized {path}")
-    blueprints.sort(key=lambda v: v.get("index", 0))
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            path = dir_path / entry.name
+            if entry.is_dir():
+                blueprints.append(_read_files_rec(path, load_file, books))
+            elif entry.is_file():
+                if path.suffix != ".json":
+                    eprint(f"Ignoring non-json file: {path}")
+                    continue
+                if entry.name in ("_metadata.json", FINGERPRINTS_FILE):
+                    continue
+                blueprints.append(load_file(path))
+            else:
+                eprint(f"Skipping unrecognized {path}")
     return data
 
 
+def read_json_file(path: Path, verbose: bool) -> Any:
+    if verbose:
+        eprint(f"Loading {path}")
+    return json.loads(path.read_text(encoding="utf8"))
+
+
+@dataclass
+class EncodedJson:
+    """A book entry that was already processed and converted with to_json().
+    It is written as is by iter_json_chunks()"""
+    json: str
+    index: int
+
+
+class EncodeCache:
+    """Cache of the processed directory files and of the last encoded result, stored as a JSON file.
+    A file is read again only if its size or modification time has changed,
+    and it is processed again only if its content hash has changed."""
+
+    def __init__(self, path: Path, root: Path, processor: "Processor"):
+        self.path = path
+        self.root = root
+        self.processor = processor
+        self.old_files: Dict[str, dict] = {}
+        self.files: Dict[str, dict] = {}
+        self.json_hash: Optional[str] = None
+        self.result: Optional[str] = None
+        self.is_modified = False
+        if path.is_file():
+            try:
+                cache = json.loads(path.read_text(encoding="utf8"))
+                if cache.get("version") == ENCODE_CACHE_VERSION and cache.get("root") == root.resolve().as_posix():
+                    self.old_files = cache["files"]
+                    self.json_hash = cache["json_hash"]
+                    self.result = cache["result"]
+                elif processor.verbose:
+                    eprint(f"Ignoring cache {path} created for a different directory or version")
+            except (ValueError, KeyError, TypeError, AttributeError) as ex:
+                eprint(f"Ignoring invalid cache {path}: {ex}")
+
+    def load_file(self, path: Path) -> EncodedJson:
+        key = path.relative_to(self.root).as_posix()
+        stat = path.stat()
+        entry = self.old_files.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            content = path.read_bytes()
+            content_hash = hashlib.sha1(content).hexdigest()
+            if entry is None or entry["hash"] != content_hash:
+                if self.processor.verbose:
+                    eprint(f"Loading {path}")
+                data = json.loads(content.decode("utf8"))
+                self.processor._process_ids_rec(data, True, self.processor.process_blueprint)
+                entry = dict(json=to_json(data), index=data.get("index", 0))
+            entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns, hash=content_hash)
+            self.is_modified = True
+        elif self.processor.verbose:
+            eprint(f"Using cached {path}")
+        self.files[key] = entry
+        return EncodedJson(entry["json"], entry["index"])
+
+    def encode(self, data: dict) -> str:
+        """Encode data returned by read_files(), or return the previous result if the JSON has not changed"""
+        data.pop("index", None)
+        with self.processor.phase("process_ids"):
+            self.processor.process_ids(data, to_abs_ids=True)
+        with self.processor.phase("encode"):
+            return self._encode(data)
+
+    def _encode(self, data: dict) -> str:
+        chunks = list(iter_json_chunks(data))
+        json_hash = hashlib.sha1()
+        json_size = 0
+        for chunk in chunks:
+            chunk = chunk.encode("utf8")
+            json_hash.update(chunk)
+            json_size += len(chunk)
+        json_hash = json_hash.hexdigest()
+        if json_hash == self.json_hash and self.result is not None:
+            eprint("Content has not changed, using the cached blueprint string")
+            if self.processor.stats is not None:
+                self.processor.stats.add_sizes(len(self.result), 0, json_size)
+        else:
+            self.json_hash = json_hash
+            self.result = "".join(iter_compressed_text(chunks, self.processor.stats))
+            self.is_modified = True
+        return self.result
+
+    def save(self) -> None:
+        if not self.is_modified and self.files.keys() == self.old_files.keys():
+            return
+        cache = dict(version=ENCODE_CACHE_VERSION, root=self.root.resolve().as_posix(), files=self.files,
+                     json_hash=self.json_hash, result=self.result)
+        # Write to a temporary file first to avoid leaving a partially written cache
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(to_json(cache), "utf8")
+        tmp_path.replace(self.path)
+
+
 def assert_clipboard():
+    if _clipboard_disabled.get():
+        raise ValueError("Clipboard cannot be used by the serve requests, use the source or the input instead")
     if pyperclip is None:
         raise ValueError("pyperclip library is required to use clipboard.\n"
                          "Install it with:   pip3 install pyperclip\n"
                          "See https://github.com/nyurik/fatul#readme")
 
 
-@dataclass
+class Stats:
+    """Time of each processing phase, entity and reference counts, and data sizes, reported by --stats.
+    Top level phases do not overlap - a phase that starts inside another one is counted as part of it."""
+
+    def __init__(self, fmt: StatsFormat):
+        self.format = fmt
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.blueprints: List[dict] = []
+        # Length of the blueprint string, and the size of the compressed and the JSON data in bytes
+        self.string_size = 0
+        self.compressed_size = 0
+        self.json_size = 0
+        self._in_phase = False
+
+    def __getstate__(self):
+        # Worker processes get the processor with its statistics, but only need an empty copy to measure their own
+        return dict(self.__dict__, phases={}, blueprints=[])
+
+    @contextmanager
+    def phase(self, name: str, target: Optional[dict] = None):
+        """Measure the time of a top level phase, or of a blueprint's phase if target is given"""
+        if target is None and self._in_phase:
+            yield
+            return
+        if target is None:
+            self._in_phase = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            phases = self.phases if target is None else target["phases"]
+            phases[name] = phases.get(name, 0) + elapsed
+            if target is None:
+                self._in_phase = False
+
+    def add_blueprint(self, label: str, entities: int) -> dict:
+        bp_stats = dict(label=label, entities=entities, references=0, phases={})
+        self.blueprints.append(bp_stats)
+        return bp_stats
+
+    def add_sizes(self, string_size: int, compressed_size: int, json_size: int) -> None:
+        self.string_size += string_size
+        self.compressed_size += compressed_size
+        self.json_size += json_size
+
+    def get_report(self) -> dict:
+        bp_phases = {}
+        for bp_stats in self.blueprints:
+            for name, elapsed in bp_stats["phases"].items():
+                bp_phases[name] = bp_phases.get(name, 0) + elapsed
+        report = dict(
+            total_time=time.perf_counter() - self.start,
+            phases=self.phases,
+            blueprint_phases=bp_phases,
+            blueprints=len(self.blueprints),
+            entities=sum(v["entities"] for v in self.blueprints),
+            references=sum(v["references"] for v in self.blueprints),
+            string_size=self.string_size,
+            compressed_size=self.compressed_size,
+            json_size=self.json_size,
+            compression_ratio=round(self.json_size / self.compressed_size, 2) if self.compressed_size else None,
+            peak_memory=None,
+            per_blueprint=self.blueprints,
+        )
+        if resource is not None:
+            # Linux reports the maximum resident set size in kilobytes, macOS in bytes
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report["peak_memory"] = max_rss if sys.platform == "darwin" else max_rss * 1024
+        return report
+
+    def report(self) -> None:
+        report = self.get_report()
+        if self.format == "json":
+            eprint(json.dumps(report, ensure_ascii=False))
+            return
+        eprint("Statistics:")
+        eprint(f"  total time          {report['total_time']:9.3f}s")
+        for name, elapsed in report["phases"].items():
+            eprint(f"    {name:<18}{elapsed:9.3f}s")
+        if report["blueprints"]:
+            eprint("  blueprint phases (included in the phases above)")
+            for name, elapsed in report["blueprint_phases"].items():
+                eprint(f"    {name:<18}{elapsed:9.3f}s")
+        for key in ("blueprints", "entities", "references", "string_size", "compressed_size", "json_size",
+                    "compression_ratio", "peak_memory"):
+            if report[key] is not None:
+                eprint(f"  {key.replace('_', ' '):<20}{report[key]:>10}")
+        # Only the slowest blueprints are listed, the JSON report has all of them
+        slowest = sorted(self.blueprints, key=lambda v: -sum(v["phases"].values()))[:STATS_MAX_BLUEPRINTS]
+        if len(slowest) > 1:
+            eprint("  slowest blueprints")
+            for bp_stats in slowest:
+                phases = ", ".join(f"{k} {v:.3f}s" for k, v in bp_stats["phases"].items())
+                eprint(f"    {bp_stats['label']}: {bp_stats['entities']} entities, "
+                       f"{bp_stats['references']} references, {phases}")
+
+
 class PosEntity:
-    pos: Position
-    entity: dict
-    hash: Optional[str] = None
+    """An entity with its packed position, and the hash of a stacked entity"""
+    __slots__ = ("pos", "entity", "hash")
+
+    def __init__(self, pos: Position, entity: dict, hash: Optional[str] = None):
+        self.pos = pos
+        self.entity = entity
+        self.hash = hash
 
 
 class Processor:
     def __init__(self, verbose: bool, sort_mode: SortMode = "none", ids_mode: IdsMode = "keep", normalize_shift=False,
-                 compact=False, merge_index=False, merge_shift=False, override_shift=None):
+                 compact=False, merge_index=False, merge_shift=False, override_shift=None, jobs=1,
+                 merge_budget=MERGE_VOTE_BUDGET, incremental=False, stats: Optional["Stats"] = None,
+                 match_files=False):
         self.verbose = verbose
         self.normalize_shift = normalize_shift
-        self.disable_shift = False
-        self.sort_keys = sort_mode == "all" or sort_mode == "keys"
-        self.sort_entities = sort_mode == "all" or sort_mode == "entities"
+        self.sort_keys = sort_mode in ("all", "hilbert", "keys")
+        self.sort_entities = sort_mode in ("all", "hilbert", "entities")
+        self.sort_curve: SortCurve = "hilbert" if sort_mode == "hilbert" else "morton"
         self.remove_entity_number = ids_mode == "refs"
         self.use_rel_ids = ids_mode != "keep"
         self.compact = compact
         self.merge_index = merge_index
         self.merge_shift = merge_shift
+        self.merge_budget = merge_budget
         self.override_shift = (None, None) if override_shift is None else override_shift
+        # Number of worker processes, 0 means all CPU cores
+        self.jobs = jobs
+        # Blueprint book entries are processed only if they have changed, when they are about to be written
+        self.incremental = incremental
+        self.stats = stats
+        # Book entries written to an existing directory are matched to the old files by their entities
+        self.match_files = match_files
+
+    def phase(self, name: str, target: Optional[dict] = None):
+        """Measure the time of a processing phase if the statistics are enabled"""
+        return nullcontext() if self.stats is None else self.stats.phase(name, target)
 
     def decode(self, json_text: str) -> dict:
         if not json_text.startswith("0"):
             raise ValueError("Invalid blueprint string. It must start with a 0.")
-        data = json.loads(zlib.decompress(base64.b64decode(json_text[1:])).decode("utf8"))
-        self.process_ids(data, to_abs_ids=False)
+        with self.phase("decompress"):
+            compressed = base64.b64decode(json_text[1:])
+            json_bytes = zlib.decompress(compressed)
+        if self.stats is not None:
+            self.stats.add_sizes(len(json_text), len(compressed), len(json_bytes))
+        with self.phase("json_parse"):
+            data = json.loads(json_bytes.decode("utf8"))
+        if self.incremental:
+            if type(data) != dict or len(data) != 1:
+                raise ValueError("Invalid blueprint string. It must contain exactly one object.")
+            return data
+        with self.phase("process_ids"):
+            self.process_ids(data, to_abs_ids=False)
         if self.sort_keys:
-            sort_dicts_rec(data)
+            with self.phase("sort"):
+                sort_dicts_rec(data, skip_blueprints=True)
         return data
 
+    def decode_stream(self, chunks: Iterable[str], dest: Path) -> None:
+        """Decode a blueprint string and write it to the destination directory,
+        keeping only one entry of the blueprint book in memory at a time."""
+        reader = JsonStreamReader(iter_decompressed_text(chunks, self.stats))
+        if dest.is_file() or dest.suffix == ".json" or not reader.match(BOOK_START_RE):
+            # Not a book, or the book is saved as a single file - decode the whole value
+            with self.phase("json_parse"):
+                data = reader.read_value()
+                reader.expect_end()
+            if not self.incremental:
+                with self.phase("process_ids"):
+                    self.process_ids(data, to_abs_ids=False)
+                if self.sort_keys:
+                    with self.phase("sort"):
+                        sort_dicts_rec(data, skip_blueprints=True)
+            self.write_files(data, dest)
+            return
+        self._stream_book(reader, dest)
+        if reader.peek() != "}":
+            raise ValueError("Invalid blueprint string. It must contain exactly one object.")
+        reader.expect("}")
+        reader.expect_end()
+
+    def _stream_book(self, reader: "JsonStreamReader", dest: Path) -> None:
+        eprint(f"Creating blueprint book {dest}")
+        dest.mkdir(parents=True, exist_ok=True)
+        book = {}
+        files = set()
+        fingerprints = BookFingerprints(dest, self.options_key) if self.incremental else None
+        nested_fingerprints = [] if self.incremental else None
+        reader.expect("{")
+        first_key = True
+        while reader.peek() != "}":
+            if not first_key:
+                reader.expect(",")
+            first_key = False
+            key = reader.read_string()
+            reader.expect(":")
+            if key != "blueprints":
+                book[key] = reader.read_value()
+                continue
+            reader.expect("[")
+            first_item = True
+            while reader.peek() != "]":
+                if not first_item:
+                    reader.expect(",")
+                first_item = False
+                # Reading the stream includes decompressing it
+                with self.phase("json_parse"):
+                    bp = reader.read_value()
+                bp_dest = dest / get_book_entry_name(bp, files)
+                if fingerprints is not None:
+                    if fingerprints.is_unchanged(bp, bp_dest):
+                        continue
+                else:
+                    with self.phase("process_ids"):
+                        self._process_ids_rec(bp, False, self.process_blueprint)
+                    if self.sort_keys:
+                        with self.phase("sort"):
+                            sort_dicts_rec(bp, skip_blueprints=True)
+                self._write_files_rec(bp, bp_dest, self.write_single_file, nested_fingerprints)
+            reader.expect("]")
+        reader.expect("}")
+        data = {"blueprint_book": book}
+        if self.sort_keys:
+            sort_dicts_rec(data)
+        self.write_metadata(data, dest)
+        if fingerprints is not None:
+            for store in chain(nested_fingerprints, [fingerprints]):
+                store.save()
+
     def encode(self, data: dict) -> str:
+        result = io.StringIO()
+        self.encode_to(data, result)
+        return result.getvalue()
+
+    def encode_to(self, data: dict, stream: TextIO) -> None:
+        """Encode data to a blueprint string, writing it to the stream as it is being compressed"""
+        for chunk in self.encode_chunks(data):
+            stream.write(chunk)
+
+    def encode_chunks(self, data: dict) -> Iterator[str]:
+        """Process the IDs right away, and return the chunks of the blueprint string as they are being compressed"""
         # if this was part of a blueprint book, get rid of the index in the output
         # the index will be re-added by migrate_old_data() when decoding into the same file
         data.pop("index", None)
-        self.disable_shift = True
-        self.process_ids(data, to_abs_ids=True)
-        compressed = zlib.compress(bytes(to_json(data), "utf8"), level=9)
-        return "0" + base64.b64encode(compressed).decode("utf8")
+        with self.phase("process_ids"):
+            self.process_ids(data, to_abs_ids=True)
+        return self._iter_encoded_chunks(data)
+
+    def _iter_encoded_chunks(self, data: dict) -> Iterator[str]:
+        with self.phase("encode"):
+            yield from iter_compressed_text(iter_json_chunks(data), self.stats)
 
     def process_ids(self, data: dict, to_abs_ids: bool):
         if type(data) != dict or len(data) != 1:
             raise ValueError("Invalid blueprint string. It must contain exactly one object.")
         if self.verbose:
             eprint(f"Processing {get_label(data)}")
-        self._process_ids_rec(data, to_abs_ids)
-
-    def _process_ids_rec(self, data: Any, to_abs_ids: bool) -> None:
+        if self.jobs == 1:
+            self._process_ids_rec(data, to_abs_ids, self.process_blueprint)
+            return
+        # Collect all blueprints first, and process them in the worker processes
+        blueprints = []
+        self._process_ids_rec(data, to_abs_ids, lambda bp_data, _: blueprints.append(bp_data))
+        if len(blueprints) < 2:
+            for bp_data in blueprints:
+                self.process_blueprint(bp_data, to_abs_ids)
+            return
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self._process_blueprint_job, blueprints, repeat(to_abs_ids))
+            for bp_data, (result, bp_stats, messages) in zip(blueprints, results):
+                # Replace the content in place to keep the parent's key order and list positions
+                bp_data.clear()
+                bp_data.update(result)
+                if bp_stats is not None:
+                    self.stats.blueprints.append(bp_stats)
+                print_worker_messages(messages)
+
+    def _process_blueprint_job(self, data: dict, to_abs_ids: bool) -> Tuple[dict, Optional[dict], List[str]]:
+        """Process a blueprint in a worker process, and return it together with its statistics and messages"""
+        messages = []
+        with _log_to(messages.append):
+            result = self.process_blueprint(data, to_abs_ids)
+        return result, None if self.stats is None else self.stats.blueprints[-1], messages
+
+    def _process_ids_rec(self, data: Any, to_abs_ids: bool, process: Callable[[dict, bool], Any]) -> None:
         if type(data) == dict:
             if "blueprint" in data:
-                bp = Blueprint(self, data, to_abs_ids)
-                if to_abs_ids:
-                    bp.create_new_entity_numbers()
-                else:
-                    bp.cache_entity_numbers()
-                bp.update_references()
-                if self.remove_entity_number:
-                    bp.delete_entity_numbers()
-                if self.disable_shift:
-                    bp.set_shift(None)
-                elif self.normalize_shift:
-                    bp.shift_by_usage()
+                process(data, to_abs_ids)
             else:
                 for key, val in data.items():
                     if type(val) in COMPLEX_TYPES:
-                        self._process_ids_rec(val, to_abs_ids)
+                        self._process_ids_rec(val, to_abs_ids, process)
         elif type(data) == list:
             for idx, val in enumerate(data):
                 if type(val) in COMPLEX_TYPES:
-                    self._process_ids_rec(val, to_abs_ids)
+                    self._process_ids_rec(val, to_abs_ids, process)
+
+    def process_blueprint(self, data: dict, to_abs_ids: bool) -> dict:
+        bp = Blueprint(self, data, to_abs_ids)
+        bp_stats = None if self.stats is None else self.stats.add_blueprint(bp.label, len(bp.entities))
+        with self.phase("entity_numbers", bp_stats):
+            if to_abs_ids:
+                bp.create_new_entity_numbers()
+            else:
+                bp.cache_entity_numbers()
+        with self.phase("references", bp_stats):
+            # Sorting the keys of the entities is a part of the same walk, see sort_other_keys()
+            bp.update_references(self.sort_keys)
+            if self.remove_entity_number:
+                bp.delete_entity_numbers()
+        with self.phase("shift", bp_stats):
+            if to_abs_ids:
+                # Encoded blueprints never have a shift, it is only stored in the decoded files
+                bp.set_shift(None)
+            elif self.normalize_shift:
+                bp.shift_by_usage()
+        if self.sort_keys:
+            with self.phase("sort", bp_stats):
+                bp.sort_other_keys(data)
+        if bp_stats is not None:
+            # Stacked entities that were referenced before their update are hashed during the references phase
+            bp_stats["phases"]["references"] -= bp.ids.hash_time
+            bp_stats["phases"]["hash"] = bp.ids.hash_time
+            bp_stats["references"] = bp.ids.references
+        return data
+
+    @property
+    def max_workers(self) -> Optional[int]:
+        return None if self.jobs == 0 else self.jobs
 
     def write_files(self, data: dict, dest: Path) -> None:
+        fingerprints = [] if self.incremental else None
+        if self.jobs == 1:
+            self._write_files_rec(data, dest, self.write_single_file, fingerprints)
+        else:
+            # Worker processes do not report their phases, so the time is measured as a single phase
+            with self.phase("write"):
+                self._write_files_parallel(data, dest, fingerprints)
+        # Fingerprints are saved last, because they include the size and the modification time of the written files
+        for store in fingerprints or []:
+            store.save()
+
+    def _write_files_parallel(self, data: dict, dest: Path, fingerprints: Optional[List["BookFingerprints"]]) -> None:
+        # Create all directories and pick all file names first, keeping the order of the duplicate-name suffixes.
+        # Old data merging and JSON formatting is done by the worker processes, and the files are written by threads.
+        files = []
+        self._write_files_rec(data, dest, lambda file_data, file_dest: files.append((file_data, file_dest)),
+                              fingerprints)
+        if len(files) < 2:
+            for file_data, file_dest in files:
+                self.write_single_file(file_data, file_dest)
+            return
+        with ProcessPoolExecutor(max_workers=self.max_workers) as processes, ThreadPoolExecutor() as threads:
+            rendered = {processes.submit(self._render_file_job, file_data, file_dest): file_dest
+                        for file_data, file_dest in files}
+            writes = []
+            for f in as_completed(rendered):
+                text, messages = f.result()
+                print_worker_messages(messages)
+                # Threads do not inherit the log callback, so run the write in a copy of the current context
+                writes.append(threads.submit(copy_context().run, rendered[f].write_text, text, "utf8"))
+            for f in writes:
+                f.result()
+
+    def _render_file_job(self, data: dict, dest: Path) -> Tuple[str, List[str]]:
+        """Render a file in a worker process, and return the text together with the messages"""
+        messages = []
+        with _log_to(messages.append):
+            text = self.render_single_file(data, dest)
+        return text, messages
+
+    def _write_files_rec(self, data: dict, dest: Path, write: Callable[[dict, Path], Any],
+                         fingerprints: Optional[List["BookFingerprints"]] = None) -> None:
         # We are "loading" now
         label = get_label(data)
         if "blueprint_book" not in data:
             dest = dest.with_suffix(".json")
             eprint(f"Writing {label} to {dest}")
-            self.write_single_file(data, dest)
+            write(data, dest)
             return
         if dest.is_file() or dest.suffix == ".json":
             eprint(f"WARNING: Destination "
                    f"{'already exists' if dest.is_file() else 'has a .json extension, treating it as a file'}. "
                    f"Saving entire blueprint book as a single file to {dest}")
-            self.write_single_file(data, dest)
+            write(data, dest)
             return
         eprint(f"Creating {label} {dest}")
         dest.mkdir(parents=True, exist_ok=True)
         book = data["blueprint_book"]
         blueprints = book.pop("blueprints", [])
-        (dest / "_metadata.json").write_text(to_pretty_json(data, self.compact) + "\n", "utf8")
+        if self.incremental and self.sort_keys:
+            sort_dicts_rec(data)
+        self.write_metadata(data, dest)
         files = set()
-        for bp in blueprints:
-            is_dir = "blueprint_book" in bp
-            name = get_label(bp).lower()
-            name = re.sub(r"[/\\.:&|]+", "-", name)
-            name = re.sub(r"  +", " ", name)
-            name = name.replace(" ", "-")
-            name = re.sub(r"-+", "-", name)
-            name = name.strip("_-. ")
-            if name in files:
-                copy = 2
-                while True:
-                    test_name = f"{name}{'_' if is_dir else ' '}({copy})"
-                    if test_name not in files:
-                        name = test_name
-                        break
-                    copy += 1
-            files.add(name)
-            self.write_files(bp, dest / name)
+        store = None
+        if fingerprints is not None:
+            store = BookFingerprints(dest, self.options_key)
+            fingerprints.append(store)
+        names = [get_book_entry_name(bp, files) for bp in blueprints]
+        unchanged = [store is not None and store.is_unchanged(bp, dest / name) for bp, name in zip(blueprints, names)]
+        if self.match_files:
+            BookFileMatcher(dest, self.verbose).rename_matched_files(blueprints, names, unchanged)
+        for bp, name, skip in zip(blueprints, names, unchanged):
+            if not skip:
+                self._write_files_rec(bp, dest / name, write, fingerprints)
+
+    def write_metadata(self, data: dict, dest: Path) -> None:
+        path = dest / "_metadata.json"
+        text = to_pretty_json(data, self.compact) + "\n"
+        # Keep the modification time of an unchanged file during the incremental decode
+        if not self.incremental or not path.is_file() or path.read_text(encoding="utf8") != text:
+            path.write_text(text, "utf8")
+
+    @property
+    def options_key(self) -> str:
+        """All options that affect the decoded files, used to detect changes during the incremental decode"""
+        return to_json([FINGERPRINTS_VERSION, self.sort_keys, self.sort_entities, self.sort_curve,
+                        self.remove_entity_number, self.use_rel_ids, self.compact, self.normalize_shift,
+                        self.merge_index, self.merge_shift, self.merge_budget, self.override_shift])
 
     def write_single_file(self, data: dict, dest: Path) -> None:
+        text = self.render_single_file(data, dest)
+        with self.phase("write"):
+            dest.write_text(text, "utf8")
+
+    def render_single_file(self, data: dict, dest: Path) -> str:
+        if self.incremental:
+            # During the incremental decode, the data is processed only if it will be written
+            with self.phase("process_ids"):
+                self._process_ids_rec(data, False, self.process_blueprint)
+            if self.sort_keys:
+                with self.phase("sort"):
+                    sort_dicts_rec(data, skip_blueprints=True)
         if dest.exists():
-            self.migrate_old_data(data, dest)
-        dest.write_text(to_pretty_json(data, self.compact) + "\n", "utf8")
+            with self.phase("merge"):
+                self.migrate_old_data(data, dest)
+        with self.phase("format"):
+            return to_pretty_json(data, self.compact) + "\n"
 
     def migrate_old_data(self, new_data: dict, dest: Path) -> None:
         msg = f"Overwriting {dest} with new data"
@@ -408,16 +1994,180 @@ class Processor:
             eprint(msg)
 
 
+class BookFingerprints:
+    """Fingerprints of the blueprint book entries written to a directory by the incremental decode.
+    An entry is skipped if its raw data, the decoding options, and the previously written file have not changed."""
+
+    def __init__(self, dir_path: Path, options_key: str):
+        self.path = dir_path / FINGERPRINTS_FILE
+        self.options_key = options_key
+        self.old_files: Dict[str, list] = {}
+        self.files: Dict[str, str] = {}
+        if self.path.is_file():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf8"))
+                if data.get("options") == options_key:
+                    self.old_files = data["files"]
+            except (ValueError, KeyError, AttributeError) as ex:
+                eprint(f"Ignoring invalid fingerprints file {self.path}: {ex}")
+
+    def is_unchanged(self, data: Any, dest: Path) -> bool:
+        """Record the fingerprint of a book entry, and check if it is the same as in the previous decode.
+        Nested books are never skipped, but their own entries may be."""
+        if type(data) != dict or "blueprint_book" in data:
+            return False
+        dest = dest.with_suffix(".json")
+        fingerprint = hashlib.sha1(to_json(data).encode("utf8")).hexdigest()
+        self.files[dest.name] = fingerprint
+        old = self.old_files.get(dest.name)
+        if old is None or old[0] != fingerprint:
+            return False
+        try:
+            stat = dest.stat()
+        except OSError:
+            return False
+        if old[1:] != [stat.st_size, stat.st_mtime_ns]:
+            return False
+        eprint(f"Skipping unchanged {get_label(data)} {dest}")
+        return True
+
+    def save(self) -> None:
+        files = {}
+        for name, fingerprint in self.files.items():
+            stat = (self.path.parent / name).stat()
+            files[name] = [fingerprint, stat.st_size, stat.st_mtime_ns]
+        self.path.write_text(to_json(dict(options=self.options_key, files=files)) + "\n", "utf8")
+
+
+class BookFileMatcher:
+    """Match the blueprints of a book to the existing files in its directory by their entities, so that a renamed
+    or reordered blueprint is merged with its own old file rather than with the file that has its label.
+    Each blueprint is summarized by a bottom-k MinHash sketch - the smallest hashes of its (name, x, y) entity
+    tuples in the original coordinates. Candidate pairs share at least one sketch hash, so only similar
+    blueprints are ever compared."""
+
+    def __init__(self, dir_path: Path, verbose: bool):
+        self.dir_path = dir_path
+        self.verbose = verbose
+
+    def rename_matched_files(self, blueprints: List[dict], names: List[str], unchanged: List[bool]) -> None:
+        """Rename the existing files to the names of the blueprints they match best.
+        The files of the unchanged entries (see BookFingerprints) are kept as is."""
+        renames = self.get_renames(blueprints, names, unchanged)
+        if not renames:
+            return
+        # Two files might swap their names, so all of them are moved aside first
+        for old_name in renames:
+            (self.dir_path / old_name).replace(self.dir_path / (old_name + ".rename"))
+        for old_name, new_name in renames.items():
+            eprint(f"Renaming {self.dir_path / old_name} to {new_name} to match the new blueprint label")
+            (self.dir_path / (old_name + ".rename")).replace(self.dir_path / new_name)
+
+    def get_renames(self, blueprints: List[dict], names: List[str], unchanged: List[bool]) -> Dict[str, str]:
+        """Get the old -> new names of the existing files that match a blueprint with a different name"""
+        file_names = {entry.name for entry in os.scandir(self.dir_path)
+                      if entry.is_file() and entry.name.endswith(".json")
+                      and entry.name not in ("_metadata.json", FINGERPRINTS_FILE)}
+        file_names.difference_update(name + ".json" for name, skip in zip(names, unchanged) if skip)
+        # Most blueprints keep their labels, so only their own files are read first,
+        # and all other files are only read if some blueprint does not match its own file
+        old_sketches: Dict[str, Optional[Tuple[int, ...]]] = {}
+        new_sketches = []
+        for bp, name, skip in zip(blueprints, names, unchanged):
+            sketch = None if skip else get_entity_sketch(bp)
+            if sketch is None:
+                continue
+            new_name = name + ".json"
+            if new_name in file_names:
+                old_sketch = old_sketches[new_name] = self.read_sketch(new_name)
+                if old_sketch is not None and get_sketch_similarity(sketch, old_sketch) >= FILE_MATCH_MIN_SIMILARITY:
+                    file_names.discard(new_name)
+                    continue
+            new_sketches.append((new_name, sketch))
+        if not new_sketches:
+            return {}
+        by_hash: Dict[int, List[str]] = {}
+        for file_name in file_names:
+            sketch = old_sketches[file_name] if file_name in old_sketches else self.read_sketch(file_name)
+            old_sketches[file_name] = sketch
+            for value in sketch or ():
+                by_hash.setdefault(value, []).append(file_name)
+        pairs = []
+        for new_name, sketch in new_sketches:
+            candidates = {file_name for value in sketch for file_name in by_hash.get(value, ())}
+            for file_name in candidates:
+                similarity = get_sketch_similarity(sketch, old_sketches[file_name])
+                if similarity >= FILE_MATCH_MIN_SIMILARITY:
+                    pairs.append((similarity, file_name, new_name))
+        pairs.sort(reverse=True)
+        renames = {}
+        matched_old = set()
+        matched_new = set()
+        for similarity, file_name, new_name in pairs:
+            if file_name in matched_old or new_name in matched_new:
+                continue
+            matched_old.add(file_name)
+            matched_new.add(new_name)
+            renames[file_name] = new_name
+            if self.verbose:
+                eprint(f"{file_name} matches {new_name} with the similarity of {similarity:.2f}")
+        return renames
+
+    def read_sketch(self, file_name: str) -> Optional[Tuple[int, ...]]:
+        path = self.dir_path / file_name
+        try:
+            return get_entity_sketch(json.loads(path.read_text(encoding="utf8")))
+        except ValueError as ex:
+            eprint(f"Ignoring invalid file {path} when matching the blueprints: {ex}")
+            return None
+
+
+def get_entity_sketch(data: Any) -> Optional[Tuple[int, ...]]:
+    """Get the bottom-k MinHash sketch of the blueprint entities, or None if it is not a blueprint with entities.
+    The hashes are only comparable within the same process."""
+    if type(data) != dict or type(data.get("blueprint")) != dict:
+        return None
+    bp = data["blueprint"]
+    entities = bp.get("entities")
+    if not entities:
+        return None
+    shift_x, shift_y = bp.get("shift_x", 0), bp.get("shift_y", 0)
+    try:
+        # Positions are multiples of 1/16, so adding the shift is exact, and equal ints and floats have the same hash
+        hashes = {hash((v.get("name"), v["position"]["x"] + shift_x, v["position"]["y"] + shift_y)) for v in entities}
+    except (AttributeError, KeyError, TypeError):
+        # Invalid entities are reported when the blueprint is processed
+        return None
+    return tuple(heapq.nsmallest(FILE_MATCH_SKETCH_SIZE, hashes))
+
+
+def get_sketch_similarity(sketch1: Tuple[int, ...], sketch2: Tuple[int, ...]) -> float:
+    """Estimate the Jaccard similarity of two entity sets - the share of the smallest hashes of their union
+    that both of them contain"""
+    values1, values2 = set(sketch1), set(sketch2)
+    union = heapq.nsmallest(FILE_MATCH_SKETCH_SIZE, values1 | values2)
+    return sum(1 for v in union if v in values1 and v in values2) / len(union)
+
+
 class IdEncoder:
-    def __init__(self, label, to_abs_ids, use_rel_ids):
+    def __init__(self, label, to_abs_ids, use_rel_ids, measure=False):
         self.label = label
         self.to_abs_ids = to_abs_ids
         self.use_rel_ids = use_rel_ids
         self.entity_ids: Dict[EID, PosEntity] = {}
-        self.position_to_entity_ids: Dict[Position, List[EID]] = {}
+        # A single entity ID, or a list of the stacked entity IDs at the same position
+        self.position_to_entity_ids: Dict[Position, Union[EID, List[EID]]] = {}
         self.new_id = EID(1)
+        # Positions with more than one entity and their entity IDs, which are referenced with a hash
+        self.stacked_positions: List[Position] = []
+        self.stacked_ids: Set[EID] = set()
         self.min_x: Optional[int] = None
         self.min_y: Optional[int] = None
+        # Statistics of the resolved references, and of the time spent hashing the stacked entities
+        # outside of update_entity(), only collected if measure is set
+        self.measure = measure
+        self.references = 0
+        self.hash_time = 0.0
 
     def save_entity_info(self, entity_data: dict) -> None:
         eid = entity_data["entity_number"]
@@ -432,50 +2182,179 @@ class IdEncoder:
         if type(x) not in NUMBER_TYPES or type(y) not in NUMBER_TYPES:
             raise ValueError(
                 f"Unrecognized position object {to_json(position)} in {self.label}:\n" + to_json(entity_data))
-        pos = Position((coord_to_int(x), coord_to_int(y)))
-        if self.min_x is None or self.min_x > pos[0]:
-            self.min_x = pos[0]
-        if self.min_y is None or self.min_y > pos[1]:
-            self.min_y = pos[1]
-        self.entity_ids[eid] = PosEntity(pos, entity_data)
+        x, y = coord_to_int(x), coord_to_int(y)
+        if abs(y) >= POSITION_MAX_Y:
+            raise ValueError(f"Position y is out of range in {self.label}:\n" + to_json(entity_data))
+        if self.min_x is None or self.min_x > x:
+            self.min_x = x
+        if self.min_y is None or self.min_y > y:
+            self.min_y = y
+        pos = pack_position(x, y)
+        pos_entity = PosEntity(pos, entity_data)
+        self.entity_ids[eid] = pos_entity
         ids = self.position_to_entity_ids.get(pos)
         if ids is None:
-            self.position_to_entity_ids[pos] = [eid]
+            self.position_to_entity_ids[pos] = eid
         else:
-            ids.append(eid)
-            for eid in ids:
+            # Stacked entities are referenced by their hash, which is computed by update_entity(),
+            # or by get_hash() if it is needed earlier
+            if type(ids) == int:
+                self.position_to_entity_ids[pos] = [ids, eid]
+                self.stacked_positions.append(pos)
+                self.stacked_ids.add(ids)
+            else:
+                ids.append(eid)
+            self.stacked_ids.add(eid)
+
+    def get_hash(self, pos_entity: PosEntity) -> str:
+        """Get the hash of a stacked entity, computing it if its entity was not updated yet"""
+        if pos_entity.hash is None:
+            start = time.perf_counter() if self.measure else 0.0
+            pos_entity.hash = get_obj_hash(pos_entity.entity)
+            if self.measure:
+                self.hash_time += time.perf_counter() - start
+        return pos_entity.hash
+
+    def check_stacked_hashes(self) -> None:
+        for pos in self.stacked_positions:
+            hashes = set()
+            for eid in self.position_to_entity_ids[pos]:
                 pos_entity = self.entity_ids[eid]
-                if pos_entity.hash is None:
-                    new_hash = get_obj_hash(pos_entity.entity)
-                    if any((True for v in ids if self.entity_ids[v].hash == hash)):
-                        raise ValueError(f"Duplicate hash {new_hash} in {self.label}:\n" + to_json(entity_data))
-                    pos_entity.hash = new_hash
+                entity_hash = self.get_hash(pos_entity)
+                if entity_hash in hashes:
+                    eprint(f"Warning: stacked entities with the same hash {entity_hash} in {self.label}, "
+                           f"their references cannot be told apart:\n" + to_json(pos_entity.entity))
+                hashes.add(entity_hash)
+
+    def update_entity(self, entity_number: EID, entity_data: dict, sort_keys: bool) -> None:
+        """Switch between entity_id and entity_rel (relative position) values in the nested values of the entity,
+        sort them the same way as sort_dicts_rec() does if sort_keys is set, and compute the hash of a stacked entity,
+        all in a single walk. Values without references are only walked to sort or hash them."""
+        # Stacked entities are hashed, unless get_hash() was needed before
+        pos_entity = self.entity_ids[entity_number] if entity_number in self.stacked_ids else None
+        is_hashed = pos_entity is not None and pos_entity.hash is None
+        hash_parts = {} if is_hashed else None
+        name = entity_data.get("name")
+        if type(name) != str:
+            name = None
+        reference_keys = _reference_keys_by_name.get(name)
+        if reference_keys is None:
+            reference_keys = _reference_keys_by_name.setdefault(name, set(ENTITY_REFERENCE_KEYS))
+        for key, val in entity_data.items():
+            if type(val) not in COMPLEX_TYPES:
+                continue
+            is_value_hashed = is_hashed and key not in HASH_VOLATILE_KEYS
+            if type(val) == dict and COMPLEX_TYPES.isdisjoint(map(type, val.values())):
+                # Most values are small dicts like the position, they are updated without walking them
+                if "entity_id" in val or "entity_rel" in val:
+                    self._update_dict_ids(entity_number, val)
+                if is_value_hashed:
+                    hash_parts[key] = _join_hash_json(val, {})
+                if sort_keys:
+                    sort_dict(val)
+                continue
+            has_references = (key in reference_keys or len(val) < REFERENCE_CHECK_MIN_SIZE
+                              or self._may_have_references(key, val, reference_keys))
+            if has_references or sort_keys or is_value_hashed:
+                text = self._update_value(entity_number, val, key, has_references, sort_keys, is_value_hashed)
+                if is_value_hashed:
+                    hash_parts[key] = text
+        if "entity_id" in entity_data or "entity_rel" in entity_data:
+            self._update_dict_ids(entity_number, entity_data)
+        if is_hashed and pos_entity.hash is None:
+            pos_entity.hash = get_text_hash(_join_hash_json(entity_data, hash_parts))
+        if sort_keys:
+            sort_dict(entity_data)
+
+    def _update_value(self, entity_number: EID, value: Any, value_key: str, has_references: bool, sort_keys: bool,
+                      is_hashed: bool) -> Optional[str]:
+        """Walk a top level value of an entity for update_entity() without recursion,
+        and return the hashed JSON text of the value if is_hashed is set"""
+        if not sort_keys and not is_hashed:
+            # Without sorting and hashing, the references are updated in the order they are found
+            stack = [(value, value_key)]
+            while stack:
+                data, key = stack.pop()
+                if type(data) == dict:
+                    if "entity_id" in data or "entity_rel" in data:
+                        self._update_dict_ids(entity_number, data)
+                    stack.extend([(v, k) for k, v in reversed(data.items()) if type(v) in COMPLEX_TYPES])
+                elif key != "neighbours":
+                    stack.extend([(v, None) for v in reversed(data) if type(v) in COMPLEX_TYPES])
+                elif len(data) > 0:
+                    # update_ref_list() only allows ints or strs in the neighbours lists
+                    self.update_ref_list(data, entity_number, key)
+            return None
+        result = {}
+        # Each item is (value, key, slot in the parent's hash parts, the parent's hash parts,
+        # and the hash parts of the value's children if it is hashed)
+        stack = [(value, value_key, None, result, {} if is_hashed else None)]
+        # Collect the values in pre-order. The reversed list has all children before their parent,
+        # in their original order, so that the lists of references are sorted after their values are updated.
+        values = []
+        while stack:
+            item = stack.pop()
+            values.append(item)
+            data, key, _, _, parts = item
+            if type(data) == dict:
+                if parts is None:
+                    stack.extend([(v, k, None, None, None) for k, v in data.items() if type(v) in COMPLEX_TYPES])
+                else:
+                    stack.extend([(v, k, k, parts, None if k in HASH_VOLATILE_KEYS else {})
+                                  for k, v in data.items() if type(v) in COMPLEX_TYPES])
+            elif key != "neighbours":
+                if parts is None:
+                    stack.extend([(v, None, None, None, None) for v in data if type(v) in COMPLEX_TYPES])
+                else:
+                    stack.extend([(v, None, idx, parts, {}) for idx, v in enumerate(data) if type(v) in COMPLEX_TYPES])
+            # update_ref_list() only allows ints or strs in the neighbours lists
+        for data, key, slot, parent_parts, parts in reversed(values):
+            if type(data) == dict:
+                if has_references and ("entity_id" in data or "entity_rel" in data):
+                    self._update_dict_ids(entity_number, data)
+                if parts is not None:
+                    parent_parts[slot] = _join_hash_json(data, parts)
+                if sort_keys:
+                    sort_dict(data)
+            else:
+                if parts is not None:
+                    # The hash uses the original order of the list
+                    parent_parts[slot] = "[" + ",".join(
+                        parts[idx] if idx in parts else to_json(v) for idx, v in enumerate(data)) + "]"
+                if has_references and key == "neighbours" and len(data) > 0:
+                    self.update_ref_list(data, entity_number, key)
+                if sort_keys:
+                    sort_list(data, key)
+        return result.get(None)
 
-    def update_rel_ids(self, entity_number: EID, data: Any, parent_key: str = None) -> None:
-        if type(data) == dict:
-            for key, val in data.items():
-                self.update_rel_ids(entity_number, val, key)
-            entity_id = data.get("entity_id")
-            rel_id = data.get("entity_rel")
-            if entity_id is not None:
-                if rel_id is not None:
-                    raise ValueError(f"Cannot have both entity_id and entity_rel in {entity_number}")
-                # Validate referenced entity_id, even if we don"t use it
-                rel_id = self._make_rel_id(entity_number, entity_id)
-                if self.use_rel_ids:
-                    del data["entity_id"]
-                    data["entity_rel"] = rel_id
-            elif rel_id is not None:
-                entity_id = self._parse_rel_id(entity_number, rel_id)
-                if not self.use_rel_ids:
-                    del data["entity_rel"]
-                    data["entity_id"] = entity_id
-        elif type(data) == list:
-            if len(data) == 0 or parent_key != "neighbours":
-                for val in data:
-                    self.update_rel_ids(entity_number, val)
-                return
-            self.update_ref_list(data, entity_number, parent_key)
+    @staticmethod
+    def _may_have_references(key: str, value: Any, reference_keys: Set[str]) -> bool:
+        """Check if a large top level value of an entity may contain any references by looking for the names
+        of the reference keys in its repr(), which is much faster than walking it in Python. Small values are walked
+        without checking. A false positive only makes it walk the value. The keys with references are added
+        to the reference_keys of the entity name, and are not checked again."""
+        text = repr(value)
+        if "entity_" in text or "neighbours" in text:
+            reference_keys.add(key)
+            return True
+        return False
+
+    def _update_dict_ids(self, entity_number: EID, data: dict) -> None:
+        entity_id = data.get("entity_id")
+        rel_id = data.get("entity_rel")
+        if entity_id is not None:
+            if rel_id is not None:
+                raise ValueError(f"Cannot have both entity_id and entity_rel in {entity_number}")
+            # Validate referenced entity_id, even if we don"t use it
+            rel_id = self._make_rel_id(entity_number, entity_id)
+            if self.use_rel_ids:
+                del data["entity_id"]
+                data["entity_rel"] = rel_id
+        elif rel_id is not None:
+            entity_id = self._parse_rel_id(entity_number, rel_id)
+            if not self.use_rel_ids:
+                del data["entity_rel"]
+                data["entity_id"] = entity_id
 
     def update_ref_list(self, data, entity_number, typ):
         list_is_int = all(type(v) == int for v in data)
@@ -540,21 +2419,21 @@ class IdEncoder:
            from_entity_number is the ID of the current entity,
            unless typ is one of the SPECIAL_REF_TYPES, in which case it is just a debug string."""
         assert type(to_entity_id) == int
+        if self.measure:
+            self.references += 1
         if not typ in SPECIAL_REF_TYPES:
             from_entity = self.entity_ids[from_entity_number]
-            from_x, from_y = from_entity.pos
+            from_pos = from_entity.pos
         else:
             from_entity = None
-            from_x, from_y = self.min_x, self.min_y
+            from_pos = pack_position(self.min_x, self.min_y)
         to_entity = self.entity_ids.get(to_entity_id)
         if to_entity is None:
             extra = ":\n" + to_json(from_entity.entity) if from_entity is not None else f" in {from_entity_number}"
             raise ValueError(f"Unrecognized entity ID {to_entity_id} in {self.label}{extra}")
-        x_diff = int_to_coord(to_entity.pos[0] - from_x)
-        y_diff = int_to_coord(to_entity.pos[1] - from_y)
-        result = f"{x_diff},{y_diff}"
-        if to_entity.hash is not None:
-            result += f",{to_entity.hash}"
+        result = format_rel_offset(to_entity.pos - from_pos)
+        if to_entity_id in self.stacked_ids:
+            result += f",{self.get_hash(to_entity)}"
         return result
 
     def _parse_rel_id(self, entity_number: EID, rel_id: str, typ: Optional[str] = None) -> EID:
@@ -562,31 +2441,37 @@ class IdEncoder:
            entity_number is the ID of the current entity,
            unless typ is one of the SPECIAL_REF_TYPES, in which case it is just a debug string."""
         assert type(rel_id) == str
+        if self.measure:
+            self.references += 1
         if not typ in SPECIAL_REF_TYPES:
             pe = self.entity_ids[entity_number]
-            from_x, from_y = pe.pos
+            from_pos = pe.pos
         else:
             pe = None
-            from_x, from_y = self.min_x, self.min_y
-        rel_parts = rel_id.split(",", 3)
-        if len(rel_parts) < 2 or len(rel_parts) > 3:
+            from_pos = pack_position(self.min_x, self.min_y)
+        try:
+            parsed = parse_rel_offset(rel_id)
+        except ValueError as ex:
+            extra = ":\n" + to_json(pe.entity) if pe is not None else f" in {entity_number}"
+            raise ValueError(f"{ex} in {self.label}{extra}")
+        if parsed is None:
             extra = ":\n" + to_json(pe.entity) if pe is not None else f" in {entity_number}"
             raise ValueError(f"Unrecognized relative ID {rel_id} in {self.label}{extra}")
-        pos = Position((from_x + coord_to_int(float(rel_parts[0])),
-                        from_y + coord_to_int(float(rel_parts[1]))))
+        offset, rel_hash = parsed
+        pos = from_pos + offset
         ids = self.position_to_entity_ids.get(pos)
         if ids is None:
             extra = ":\n" + to_json(pe.entity) if pe is not None else f" in {entity_number}"
             raise ValueError(
-                f"No entities found for relative ID {rel_id} ({pos[0], pos[1]}) in {self.label}{extra}")
-        if len(ids) == 1:
-            if len(rel_parts) == 3:
-                eprint(f"Warning: ignoring hash {rel_parts[2]} in {self.label}")
-            return ids[0]
-        if len(rel_parts) == 2:
+                f"No entities found for relative ID {rel_id} {unpack_position(pos)} in {self.label}{extra}")
+        if type(ids) == int:
+            if rel_hash is not None:
+                eprint(f"Warning: ignoring hash {rel_hash} in {self.label}")
+            return ids
+        if rel_hash is None:
             raise ValueError(
                 f"Ambiguous relative ID {rel_id} must have had a hash in {self.label}:\n{to_json(pe.entity)}")
-        ids = [v for v in ids if self.entity_ids[v].hash == rel_parts[2]]
+        ids = [v for v in ids if self.get_hash(self.entity_ids[v]) == rel_hash]
         if len(ids) == 0:
             raise ValueError(f"Hash for relative ID {rel_id} not found in {self.label}:\n{to_json(pe.entity)}")
         return ids[0]
@@ -606,11 +2491,23 @@ class IdEncoder:
 class Blueprint:
     def __init__(self, processor: Processor, data: dict, to_abs_ids: bool):
         self.sort_entities = processor.sort_entities
+        self.sort_curve = processor.sort_curve
         self.override_shift = processor.override_shift
+        self.merge_budget = processor.merge_budget
         self.blueprint = data["blueprint"]
         self.label = get_label(data)
         self.entities = self.blueprint.get("entities", [])
-        self.ids = IdEncoder(self.label, to_abs_ids, processor.use_rel_ids)
+        self.ids = IdEncoder(self.label, to_abs_ids, processor.use_rel_ids, processor.stats is not None)
+        self._table: Optional[EntityTable] = None
+        self._is_table_created = False
+
+    @property
+    def table(self) -> Optional["EntityTable"]:
+        """Columnar view of the entities, or None if NumPy is not available or not useful"""
+        if not self._is_table_created:
+            self._table = EntityTable.create(self.entities)
+            self._is_table_created = True
+        return self._table
 
     def cache_entity_numbers(self) -> None:
         for idx, entity_data in enumerate(self.entities):
@@ -633,16 +2530,24 @@ class Blueprint:
         for entity_data in self.entities:
             del entity_data["entity_number"]
 
-    def update_references(self):
-        # Recursively switch between entity_id and entity_rel (relative position)
+    def update_references(self, sort_keys=False):
         for entity_data in self.entities:
-            self.ids.update_rel_ids(entity_data["entity_number"], entity_data)
+            self.ids.update_entity(entity_data["entity_number"], entity_data, sort_keys)
         for idx, locomotive in enumerate(self.blueprint.get("schedules", [])):
             self.ids.update_ref_list(locomotive["locomotives"], f"schedule[{idx}]", "locomotives")
         for idx, wires in enumerate(self.blueprint.get("wires", [])):
             self.ids.update_wires_list(wires, f"wires[{idx}]", "wires")
         for idx, conn in enumerate(self.blueprint.get("stock_connections", [])):
             self.ids.update_obj_values(conn, f"stock_connections[{idx}]", "stock_connections")
+        self.ids.check_stacked_hashes()
+
+    def sort_other_keys(self, data: dict) -> None:
+        """Sort the blueprint like sort_dicts_rec(), except for the entities sorted by update_references()"""
+        for key, val in self.blueprint.items():
+            if key != "entities":
+                sort_dicts_rec(val, key)
+        sort_dict(self.blueprint)
+        sort_dict(data)
 
     def shift_by_usage(self):
         hist_x = self.calc_histogram("x", by_name=False)
@@ -656,18 +2561,86 @@ class Blueprint:
             return "shift is unchanged because old blueprint has no entities"
         if not self.entities:
             return "shift is unchanged because new blueprint has no entities"
-        old_hist_x = old_bp.calc_histogram("x", by_name=True)
-        new_hist_x = self.calc_histogram("x", by_name=True)
-        shift_x = self.calc_histogram_diff(old_hist_x, new_hist_x)
-        old_hist_y = old_bp.calc_histogram("y", by_name=True)
-        new_hist_y = self.calc_histogram("y", by_name=True)
-        shift_y = self.calc_histogram_diff(old_hist_y, new_hist_y)
+        shift = self.calc_offset_by_votes(old_bp)
+        if shift is not None:
+            shift_x, shift_y = shift
+        else:
+            old_hist_x = old_bp.calc_histogram("x", by_name=True)
+            new_hist_x = self.calc_histogram("x", by_name=True)
+            shift_x = self.calc_histogram_diff(old_hist_x, new_hist_x)
+            old_hist_y = old_bp.calc_histogram("y", by_name=True)
+            new_hist_y = self.calc_histogram("y", by_name=True)
+            shift_y = self.calc_histogram_diff(old_hist_y, new_hist_y)
         if shift_x == 0 and shift_y == 0:
             return "entities were not shifted"
         else:
             self.set_shift((shift_x, shift_y))
             return f"entities shifted by x={shift_x}, y={shift_y}"
 
+    def calc_offset_by_votes(self, old_bp: "Blueprint") -> Optional[Tuple[int, int]]:
+        """Find the x,y shift that places the most new entities exactly on top of the old ones with the same name.
+        Every pair of old and new entities with the same name votes for the whole-tile offset between them,
+        starting with the rarest names, until merge_budget pairs are compared. The best voted offsets are then
+        verified against all entities. Returns None if no offset matches enough entities."""
+        if self.merge_budget <= 0:
+            return None
+        old_groups = old_bp.group_positions()
+        new_groups = self.group_positions()
+
+        # Rare entities produce fewer random votes, so use them first
+        keys = sorted((len(old_groups[k][0]) * len(new_xs), k) for k, (new_xs, _) in new_groups.items()
+                      if k in old_groups)
+        votes_by_weight: Dict[int, Counter] = {}
+        budget = self.merge_budget
+        for _, key in keys:
+            old_xs, old_ys = old_groups[key]
+            new_xs, new_ys = new_groups[key]
+            votes = votes_by_weight.setdefault(ENTITY_SCORES.get(key[0], 1), Counter())
+            for new_x, new_y in zip(new_xs, new_ys):
+                if budget < len(old_xs):
+                    break
+                budget -= len(old_xs)
+                # Both positions have the same fraction, so the offset is always a whole number of tiles
+                votes.update(zip(map(operator.sub, old_xs, repeat(new_x)), map(operator.sub, old_ys, repeat(new_y))))
+            if budget < len(old_xs):
+                break
+        votes = {}
+        for weight, weight_votes in votes_by_weight.items():
+            for offset, count in weight_votes.items():
+                votes[offset] = votes.get(offset, 0) + count * weight
+        if not votes:
+            return None
+
+        # Verify the best candidates by counting the entities that match exactly after the shift
+        old_entities = {(key, pos) for key, (xs, ys) in old_groups.items() for pos in zip(xs, ys)}
+        best_offset, best_score = None, 0
+        candidates = heapq.nsmallest(MERGE_VOTE_CANDIDATES, votes.items(),
+                                     key=lambda v: (-v[1], abs(v[0][0]) + abs(v[0][1]), v[0]))
+        for (dx, dy), _ in candidates:
+            score = sum(ENTITY_SCORES.get(key[0], 1) * sum(1 for x, y in zip(xs, ys)
+                                                           if (key, (x + dx, y + dy)) in old_entities)
+                        for key, (xs, ys) in new_groups.items())
+            if score > best_score:
+                best_offset, best_score = (dx, dy), score
+        total_score = sum(ENTITY_SCORES.get(v["name"], 1) for v in self.entities)
+        if best_offset is None or best_score < total_score * MERGE_VOTE_MIN_MATCH:
+            return None
+        # The offset is how much the new entities should move, the shift is the opposite
+        return -best_offset[0] // COORD_MULTIPLIER, -best_offset[1] // COORD_MULTIPLIER
+
+    def group_positions(self) -> Dict[Tuple[str, int, int], Tuple[List[int], List[int]]]:
+        """Group entity x and y coordinates by entity name and by the fractional part of the position"""
+        groups = {}
+        for entity in self.entities:
+            position = entity["position"]
+            x, y = coord_to_int(position["x"]), coord_to_int(position["y"])
+            group = groups.get((entity["name"], x % COORD_MULTIPLIER, y % COORD_MULTIPLIER))
+            if group is None:
+                group = groups[(entity["name"], x % COORD_MULTIPLIER, y % COORD_MULTIPLIER)] = ([], [])
+            group[0].append(x)
+            group[1].append(y)
+        return groups
+
     def set_shift(self, adjust_by: Optional[Tuple[int, int]]) -> None:
         shift_x = self.blueprint.get("shift_x", 0)
         shift_y = self.blueprint.get("shift_y", 0)
@@ -689,6 +2662,8 @@ class Blueprint:
                 position = entity["position"]
                 position["x"] += adjust_x
                 position["y"] += adjust_y
+            if self._table is not None:
+                self._table.shift(adjust_x, adjust_y)
         if adjust_by is None or (target_x == 0 and target_y == 0):
             self.blueprint.pop("shift_x", None)
             self.blueprint.pop("shift_y", None)
@@ -696,7 +2671,13 @@ class Blueprint:
             self.blueprint["shift_x"] = target_x
             self.blueprint["shift_y"] = target_y
         if self.sort_entities:
-            self.entities.sort(key=entity_sort_key)
+            table = self.table
+            if table is None:
+                self.entities.sort(key=entity_sort_key if self.sort_curve == "morton" else entity_hilbert_sort_key)
+            else:
+                order = table.sort_order(self.sort_curve)
+                self.entities[:] = [self.entities[idx] for idx in order.tolist()]
+                table.reorder(order)
 
     @staticmethod
     def calc_coordinate_shift(histogram: Histogram) -> int:
@@ -766,6 +2747,9 @@ class Blueprint:
             return score
 
     def calc_histogram(self, by_x_or_y: str, by_name: bool) -> Histogram:
+        table = self.table
+        if table is not None:
+            return table.calc_histogram(by_x_or_y, by_name)
         if by_name:
             values = ((int(v["position"][by_x_or_y]), v["name"]) for v in self.entities)
         else:
@@ -775,38 +2759,306 @@ class Blueprint:
         return Histogram(res)
 
 
-def sort_dicts_rec(data: Any, parent: Optional[str] = None) -> None:
+class EntityTable:
+    """Columnar NumPy view of the blueprint entities: x,y positions multiplied by COORD_MULTIPLIER,
+    and entity name codes, ordered the same way as the names. Used for vectorized histograms and sorting."""
+
+    def __init__(self, entities: List[dict]):
+        names = [v["name"] for v in entities]
+        self.names = sorted(set(names))
+        codes = {name: idx for idx, name in enumerate(self.names)}
+        self.name_codes = numpy.fromiter((codes[v] for v in names), dtype=numpy.int64, count=len(names))
+        xs = numpy.fromiter((v["position"]["x"] for v in entities), dtype=numpy.float64, count=len(entities))
+        ys = numpy.fromiter((v["position"]["y"] for v in entities), dtype=numpy.float64, count=len(entities))
+        self.xs = numpy.round(xs * COORD_MULTIPLIER).astype(numpy.int64)
+        self.ys = numpy.round(ys * COORD_MULTIPLIER).astype(numpy.int64)
+        # Positions must be a multiple of 1/COORD_MULTIPLIER to produce the same results as the non-vectorized code
+        self.is_exact = bool(numpy.array_equal(self.xs, xs * COORD_MULTIPLIER)
+                             and numpy.array_equal(self.ys, ys * COORD_MULTIPLIER))
+
+    @staticmethod
+    def create(entities: List[dict]) -> Optional["EntityTable"]:
+        if numpy is None or len(entities) < NUMPY_MIN_ENTITIES:
+            return None
+        try:
+            table = EntityTable(entities)
+        except (KeyError, TypeError, ValueError):
+            # Let the non-vectorized code report invalid entities
+            return None
+        return table if table.is_exact else None
+
+    def shift(self, adjust_x: int, adjust_y: int) -> None:
+        self.xs += adjust_x * COORD_MULTIPLIER
+        self.ys += adjust_y * COORD_MULTIPLIER
+
+    def reorder(self, order: "numpy.ndarray") -> None:
+        self.name_codes = self.name_codes[order]
+        self.xs = self.xs[order]
+        self.ys = self.ys[order]
+
+    def sort_order(self, curve: SortCurve) -> "numpy.ndarray":
+        """Same order as sorting entities with entity_sort_key() or entity_hilbert_sort_key()"""
+        if curve == "morton":
+            numbers = to_morton_numbers(self.xs, self.ys)
+        else:
+            numbers = to_hilbert_numbers(self.xs, self.ys)
+        # lexsort is stable and uses the last key as the primary one
+        return numpy.lexsort((numbers, self.name_codes))
+
+    def calc_histogram(self, by_x_or_y: str, by_name: bool) -> Histogram:
+        values = self.xs if by_x_or_y == "x" else self.ys
+        # Same as int(position), rounding towards zero
+        tiles = numpy.where(values >= 0, values // COORD_MULTIPLIER, -(-values // COORD_MULTIPLIER))
+        if not by_name:
+            keys, counts = numpy.unique(tiles, return_counts=True)
+            return Histogram(list(zip(keys.tolist(), counts.tolist())))
+        min_tile = int(tiles.min())
+        keys, counts = numpy.unique((tiles - min_tile) * len(self.names) + self.name_codes, return_counts=True)
+        return Histogram([((tile, self.names[code]), count) for tile, code, count in zip(
+            (keys // len(self.names) + min_tile).tolist(), (keys % len(self.names)).tolist(), counts.tolist())])
+
+
+def iter_decompressed_text(chunks: Iterable[str], stats: Optional["Stats"] = None) -> Iterator[str]:
+    """Decode base64 blueprint string chunks, and decompress them into JSON text chunks"""
+    decompressor = zlib.decompressobj()
+    text_decoder = codecs.getincrementaldecoder("utf8")()
+    pending = ""
+    is_first = True
+    for chunk in chunks:
+        if stats is not None:
+            stats.add_sizes(len(chunk), 0, 0)
+        if is_first and chunk:
+            if not chunk.startswith("0"):
+                raise ValueError("Invalid blueprint string. It must start with a 0.")
+            chunk = chunk[1:]
+            is_first = False
+        # Same as b64decode(), ignore all non-alphabet characters, and decode only complete 4-character blocks
+        pending += BASE64_IGNORED_RE.sub("", chunk)
+        size = len(pending) - len(pending) % 4
+        if size:
+            compressed = base64.b64decode(pending[:size])
+            json_bytes = decompressor.decompress(compressed)
+            if stats is not None:
+                stats.add_sizes(0, len(compressed), len(json_bytes))
+            text = text_decoder.decode(json_bytes)
+            pending = pending[size:]
+            if text:
+                yield text
+    if is_first:
+        raise ValueError("Invalid blueprint string. It must start with a 0.")
+    if pending:
+        raise ValueError("Invalid blueprint string. Incorrect base64 padding.")
+    json_bytes = decompressor.flush()
+    if stats is not None:
+        stats.add_sizes(0, 0, len(json_bytes))
+    text = text_decoder.decode(json_bytes, final=True)
+    if not decompressor.eof:
+        raise ValueError("Invalid blueprint string. Compressed data is incomplete.")
+    if text:
+        yield text
+
+
+class JsonStreamReader:
+    """Read JSON values from a stream of text chunks, keeping only the unparsed part of the text in memory"""
+
+    def __init__(self, chunks: Iterator[str]):
+        self.chunks = chunks
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        # Offset of self.buf from the start of the stream
+        self.offset = 0
+        self.is_eof = False
+
+    def _read_more(self, min_size: int = 1) -> bool:
+        """Append at least min_size characters to the buffer, dropping the already parsed part"""
+        if self.pos > 0:
+            self.offset += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        parts = [self.buf]
+        size = 0
+        while size < min_size and not self.is_eof:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.is_eof = True
+            else:
+                parts.append(chunk)
+                size += len(chunk)
+        self.buf = "".join(parts)
+        return size > 0
+
+    def peek(self) -> str:
+        """Skip the whitespace and return the next character without consuming it, or an empty string at the end"""
+        while True:
+            match = JSON_WHITESPACE_RE.match(self.buf, self.pos)
+            self.pos = match.end()
+            if self.pos < len(self.buf) or not self._read_more():
+                return self.buf[self.pos:self.pos + 1]
+
+    def pos_in_stream(self) -> int:
+        return self.offset + self.pos
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"Invalid blueprint string. Expected '{char}' at position {self.pos_in_stream()}.")
+        self.pos += 1
+
+    def expect_end(self) -> None:
+        if self.peek() != "":
+            raise ValueError(f"Invalid blueprint string. Unexpected data at position {self.pos_in_stream()}.")
+
+    def match(self, pattern: re.Pattern, lookahead: int = 256) -> bool:
+        """Consume the text if it matches the pattern. The pattern must match within the lookahead characters."""
+        if len(self.buf) - self.pos < lookahead:
+            self._read_more(lookahead)
+        match = pattern.match(self.buf, self.pos)
+        if match is None:
+            return False
+        self.pos = match.end()
+        return True
+
+    def read_string(self) -> str:
+        if self.peek() != '"':
+            raise ValueError(f"Invalid blueprint string. Expected a string at position {self.pos_in_stream()}.")
+        value = self.read_value()
+        assert type(value) == str
+        return value
+
+    def read_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # The value might be incomplete, retry with at least twice as much data to keep the parsing linear
+                if self._read_more(max(len(self.buf) - self.pos, READ_CHUNK_SIZE)):
+                    continue
+                raise
+            # Numbers and literals might continue in the next chunk
+            if end < len(self.buf) or not self._read_more():
+                self.pos = end
+                return value
+
+
+def iter_json_chunks(data: Any, is_stream_value: bool = False) -> Iterator[str]:
+    """Same as to_json(), but yields the result in chunks. Blueprint books, blueprints,
+    and their entity-like lists are walked one value at a time, the rest is encoded as a whole."""
+    if type(data) == EncodedJson:
+        yield data.json
+    elif type(data) == dict and any(key in JSON_STREAM_KEYS for key in data) and all(type(key) == str for key in data):
+        yield "{"
+        first = True
+        for key, val in data.items():
+            yield to_json(key) + ":" if first else "," + to_json(key) + ":"
+            first = False
+            yield from iter_json_chunks(val, key in JSON_STREAM_KEYS)
+        yield "}"
+    elif type(data) == list and is_stream_value:
+        yield "["
+        first = True
+        for val in data:
+            if not first:
+                yield ","
+            first = False
+            yield from iter_json_chunks(val)
+        yield "]"
+    else:
+        yield to_json(data)
+
+
+def iter_compressed_text(chunks: Iterable[str], stats: Optional["Stats"] = None) -> Iterator[str]:
+    """Compress JSON text chunks and encode them as a base64 blueprint string, one block at a time.
+    The result is identical to the zlib.compress() of the whole text."""
+    compressor = zlib.compressobj(level=9)
+    if stats is not None:
+        stats.add_sizes(1, 0, 0)
+    yield "0"
+    pending = b""
+    buffer = []
+    buffer_size = 0
+    for chunk in chain(chunks, [None]):
+        if chunk is not None:
+            buffer.append(chunk)
+            buffer_size += len(chunk)
+            if buffer_size < WRITE_CHUNK_SIZE:
+                continue
+        json_bytes = "".join(buffer).encode("utf8")
+        compressed = compressor.compress(json_bytes)
+        buffer.clear()
+        buffer_size = 0
+        if chunk is None:
+            compressed += compressor.flush()
+        if stats is not None:
+            stats.add_sizes(0, len(compressed), len(json_bytes))
+        pending += compressed
+        if chunk is None:
+            size = len(pending)
+        else:
+            # Only encode complete 3-byte blocks to avoid base64 padding in the middle of the string
+            size = len(pending) - len(pending) % 3
+        if size:
+            text = base64.b64encode(pending[:size]).decode("utf8")
+            pending = pending[size:]
+            if stats is not None:
+                stats.add_sizes(len(text), 0, 0)
+            yield text
+
+
+def sort_dicts_rec(data: Any, parent: Optional[str] = None, skip_blueprints=False) -> None:
+    """Sort all dicts with sort_dict(), and the lists of references.
+    With skip_blueprints, the blueprints already sorted by Processor.process_blueprint() are not sorted again."""
     if type(data) == dict:
+        if skip_blueprints and "blueprint" in data:
+            return
         for key, val in data.items():
-            sort_dicts_rec(val, key)
+            if type(val) in COMPLEX_TYPES:
+                sort_dicts_rec(val, key, skip_blueprints)
         sort_dict(data)
     elif type(data) == list:
-        has_entity_rel = True
         for val in data:
-            has_entity_rel = has_entity_rel and type(val) == dict and "entity_rel" in val
-            sort_dicts_rec(val)
-        if has_entity_rel:
-            data.sort(key=lambda v: list(v.items()))
-        elif parent == "neighbours":
-            data.sort()
+            if type(val) in COMPLEX_TYPES:
+                sort_dicts_rec(val, None, skip_blueprints)
+        sort_list(data, parent)
+
+
+def sort_list(data: list, parent: Optional[str]) -> None:
+    if len(data) < 2:
+        return
+    if all(type(v) == dict and "entity_rel" in v for v in data):
+        data.sort(key=lambda v: tuple(v.items()))
+    elif parent == "neighbours":
+        data.sort()
 
 
 def sort_dict(data) -> None:
     """Sort dict in place.
     Order first by group (prefix) followed by the key name alphabetically.
     Put special keys like 'name' first, then simple values (strings/ints/...) then dicts/lists."""
-
-    def _key_sorter(key: str):
-        prefix = SORT_ORDER.get(key)
-        if prefix is None:
-            prefix = SORT_ORDER["_complex" if type(old_data[key]) in COMPLEX_TYPES else "_simple"]
-        return prefix + key
-
+    keys = tuple(data)
+    order = get_key_order(keys, tuple(map(type, data.values())))
+    if order is None:
+        return
     # Since Python 3.7+, dict key insertion order is officially preserved
     old_data = data.copy()
     data.clear()
-    for k in sorted(old_data.keys(), key=_key_sorter):
-        data[k] = old_data[k]
+    data.update(zip(order, map(old_data.__getitem__, order)))
+
+
+@lru_cache(maxsize=KEY_ORDER_CACHE_SIZE)
+def get_key_order(keys: Tuple[str, ...], value_types: Tuple[type, ...]) -> Optional[Tuple[str, ...]]:
+    """Get the sort_dict() order of the keys with the given value types, or None if they are already in order.
+    Most dicts have the same few key sets, so their order is computed only once."""
+    prefixes = {k: get_key_sort_prefix(k, t) + k for k, t in zip(keys, value_types)}
+    order = tuple(sorted(keys, key=prefixes.__getitem__))
+    return None if order == keys else order
+
+
+def get_key_sort_prefix(key: str, value_type: type) -> str:
+    prefix = SORT_ORDER.get(key)
+    if prefix is None:
+        prefix = SORT_ORDER["_complex" if value_type in COMPLEX_TYPES else "_simple"]
+    return prefix
 
 
 def entity_sort_key(entity: dict):
@@ -815,18 +3067,96 @@ def entity_sort_key(entity: dict):
     return entity["name"], to_morton_number(position["x"], position["y"])
 
 
+def entity_hilbert_sort_key(entity: dict):
+    """Sort blueprint entities by their position along a Hilbert curve"""
+    position = entity["position"]
+    return entity["name"], to_hilbert_number(position["x"], position["y"])
+
+
+def _spread_bits(val: int) -> int:
+    # Insert a zero bit before each bit of an 8 bit value, used to build the Morton lookup table
+    for shift, mask in [(4, 0x0F0F), (2, 0x3333), (1, 0x5555)]:
+        val = (val | (val << shift)) & mask
+    return val
+
+
+MORTON_TABLE = [_spread_bits(v) for v in range(256)]
+
+
+def to_unsigned_coord(val) -> int:
+    """Multiply the coordinate by COORD_MULTIPLIER, and normalize it to an unsigned 32 bit value"""
+    return min(max(coord_to_int(val) + (2 ** 31), 0), 2 ** 32 - 1)
+
+
 def to_morton_number(x, y) -> int:
     # Create a single interleaved number (Morton number) to use as a sorting key.
     # This approach tries to keep features that are nearby in the X,Y plane near each other in a list.
-    # Adapted from http://graphics.stanford.edu/~seander/bithacks.html#InterleaveBMN
-    def prepare_number(val):
-        # Normalize to an unsigned 16 bit value
-        val = min(max(coord_to_int(val) + (2 ** 15), 0), 2 ** 16 - 1)
-        for shift, mask in [(8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)]:
-            val = (val | (val << shift)) & mask
-        return val
+    # Bits are interleaved one byte at a time using a lookup table.
+    # Within the old 16 bit range the order is the same as before the switch to 32 bit values.
+    x = to_unsigned_coord(x)
+    y = to_unsigned_coord(y)
+    table = MORTON_TABLE
+    return ((table[x & 0xFF] | (table[(x >> 8) & 0xFF] << 16) | (table[(x >> 16) & 0xFF] << 32)
+             | (table[x >> 24] << 48))
+            | ((table[y & 0xFF] | (table[(y >> 8) & 0xFF] << 16) | (table[(y >> 16) & 0xFF] << 32)
+                | (table[y >> 24] << 48)) << 1))
+
+
+def to_hilbert_number(x, y) -> int:
+    # Distance along a Hilbert curve covering the whole 32 bit range. Unlike the Z-order curve,
+    # consecutive values are always next to each other, so the nearby features stay closer in a list.
+    # Adapted from https://en.wikipedia.org/wiki/Hilbert_curve#Applications_and_mapping_algorithms
+    x = to_unsigned_coord(x)
+    y = to_unsigned_coord(y)
+    max_val = 2 ** 32 - 1
+    res = 0
+    s = 2 ** 31
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        res += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = max_val - x
+                y = max_val - y
+            x, y = y, x
+        s >>= 1
+    return res
+
+
+def _to_unsigned_coords(values: "numpy.ndarray") -> "numpy.ndarray":
+    return numpy.clip(values + (2 ** 31), 0, 2 ** 32 - 1).astype(numpy.uint64)
 
-    return prepare_number(x) | (prepare_number(y) << 1)
+
+def to_morton_numbers(xs: "numpy.ndarray", ys: "numpy.ndarray") -> "numpy.ndarray":
+    """Vectorized version of to_morton_number() for the already multiplied coordinates"""
+
+    def prepare_numbers(values):
+        values = _to_unsigned_coords(values)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+            values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+        return values
+
+    return prepare_numbers(xs) | (prepare_numbers(ys) << numpy.uint64(1))
+
+
+def to_hilbert_numbers(xs: "numpy.ndarray", ys: "numpy.ndarray") -> "numpy.ndarray":
+    """Vectorized version of to_hilbert_number() for the already multiplied coordinates"""
+    xs = _to_unsigned_coords(xs)
+    ys = _to_unsigned_coords(ys)
+    max_val = numpy.uint64(2 ** 32 - 1)
+    res = numpy.zeros(len(xs), dtype=numpy.uint64)
+    for bit in range(31, -1, -1):
+        s = numpy.uint64(1 << bit)
+        rx = (xs & s) != 0
+        ry = (ys & s) != 0
+        res += numpy.uint64(1 << (2 * bit)) * ((3 * rx.astype(numpy.uint64)) ^ ry.astype(numpy.uint64))
+        flip = ~ry & rx
+        xs = numpy.where(flip, max_val - xs, xs)
+        ys = numpy.where(flip, max_val - ys, ys)
+        xs, ys = numpy.where(ry, xs, ys), numpy.where(ry, ys, xs)
+    return res
 
 
 def coord_to_int(val) -> int:
@@ -839,6 +3169,62 @@ def int_to_coord(val: int) -> Union[float, int]:
     return int(res) if res.is_integer() else res
 
 
+@lru_cache(maxsize=REL_ID_CACHE_SIZE)
+def parse_rel_offset(rel_id: str) -> Optional[Tuple[Position, Optional[str]]]:
+    """Parse an "x,y" or "x,y,hash" relative ID into the packed offset and the hash, or return None if it is invalid.
+    Raises ValueError if the offset is too large to be packed."""
+    rel_parts = rel_id.split(",", 3)
+    if len(rel_parts) < 2 or len(rel_parts) > 3:
+        return None
+    rel_hash = rel_parts[2] if len(rel_parts) == 3 else None
+    try:
+        x_diff = coord_to_int(float(rel_parts[0]))
+        y_diff = coord_to_int(float(rel_parts[1]))
+    except (ValueError, OverflowError):
+        return None
+    if abs(y_diff) >= POSITION_MAX_Y:
+        raise ValueError(f"Relative ID {rel_id} is out of range")
+    return pack_position(x_diff, y_diff), rel_hash
+
+
+@lru_cache(maxsize=REL_ID_CACHE_SIZE)
+def format_rel_offset(offset: Position) -> str:
+    """Format a packed offset as an "x,y" relative ID"""
+    x_diff, y_diff = unpack_position(offset)
+    return f"{int_to_coord(x_diff)},{int_to_coord(y_diff)}"
+
+
+def pack_position(x: int, y: int) -> Position:
+    """Pack the int coordinates (see coord_to_int) into a single int. The y value must be within ±POSITION_MAX_Y."""
+    return Position(x * POSITION_PACK_FACTOR + y)
+
+
+def unpack_position(pos: Position) -> Tuple[int, int]:
+    x, y = divmod(pos + POSITION_PACK_FACTOR // 2, POSITION_PACK_FACTOR)
+    return x, y - POSITION_PACK_FACTOR // 2
+
+
+def get_book_entry_name(data: dict, files: Set[str]) -> str:
+    """Get a unique file name for a blueprint book entry, and add it to the set of used names"""
+    is_dir = "blueprint_book" in data
+    name = get_label(data).lower()
+    name = re.sub(r"[/\\.:&|]+", "-", name)
+    name = re.sub(r"  +", " ", name)
+    name = name.replace(" ", "-")
+    name = re.sub(r"-+", "-", name)
+    name = name.strip("_-. ")
+    if name in files:
+        copy = 2
+        while True:
+            test_name = f"{name}{'_' if is_dir else ' '}({copy})"
+            if test_name not in files:
+                name = test_name
+                break
+            copy += 1
+    files.add(name)
+    return name
+
+
 def get_label(data: dict) -> str:
     key = get_non_index_key(data)
     label = data[key].get("label")
@@ -847,30 +3233,64 @@ def get_label(data: dict) -> str:
     return label
 
 
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
+def print_worker_messages(messages: List[str]) -> None:
+    """Print the messages collected in a worker process. The log callback is not passed to the worker processes,
+    so their messages are returned with the results, and printed by the caller."""
+    for message in messages:
+        eprint(message)
 
 
-def get_obj_hash(obj: Any) -> str:
-    """get a short string hash of the object, ignoring unstable values like entity IDs"""
+def eprint(*args, **kwargs):
+    log = _log_callback.get()
+    if log is None:
+        print(*args, file=sys.stderr, **kwargs)
+    else:
+        log(kwargs.get("sep", " ").join(str(v) for v in args))
 
-    def _rm_volatile(o: Any):
-        if type(o) == dict:
-            for k, v in list(o.items()):
-                if k in ("connections", "position", "entity_id", "entity_number", "entity_rel", "neighbours"):
-                    del o[k]
-                else:
-                    _rm_volatile(v)
-        elif type(o) == list:
-            for v in o:
-                _rm_volatile(v)
 
-    # deep clone the object and remove values that are not likely to stay the same
-    obj = json.loads(json.dumps(obj))
-    _rm_volatile(obj)
-    # sort the object to ensure the hash is stable
-    sort_dicts_rec(obj)
-    return hashlib.md5(to_json(obj).encode("utf8")).hexdigest()[:4]
+def get_obj_hash(obj: Any) -> str:
+    """get a short string hash of the object, ignoring unstable values like entity IDs.
+    The hash is computed from the same JSON text as to_json() would produce for a copy of the object
+    with all volatile keys removed, and with all keys sorted by sort_dicts_rec(), but without making that copy."""
+    parts = []
+    _append_hash_json(obj, parts)
+    return get_text_hash("".join(parts))
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.md5(text.encode("utf8")).hexdigest()[:4]
+
+
+def _join_hash_json(obj: dict, parts: Dict[str, str]) -> str:
+    """Same as _append_hash_json() for a dict, using the already computed text of its complex values"""
+    keys = tuple(k for k in obj.keys() if k not in HASH_VOLATILE_KEYS)
+    keys = get_key_order(keys, tuple(type(obj[k]) for k in keys)) or keys
+    return "{" + ",".join(to_json(str(k)) + ":" + (parts[k] if k in parts else to_json(obj[k])) for k in keys) + "}"
+
+
+def _append_hash_json(obj: Any, parts: List[str]) -> None:
+    if type(obj) == dict:
+        keys = tuple(k for k in obj.keys() if k not in HASH_VOLATILE_KEYS)
+        # Same order as sort_dict(). Lists are never sorted by sort_dicts_rec() here because
+        # "entity_rel" and "neighbours" keys are removed before sorting.
+        keys = get_key_order(keys, tuple(type(obj[k]) for k in keys)) or keys
+        parts.append("{")
+        for idx, key in enumerate(keys):
+            if idx > 0:
+                parts.append(",")
+            parts.append(to_json(str(key)))
+            parts.append(":")
+            _append_hash_json(obj[key], parts)
+        parts.append("}")
+    elif type(obj) in (list, tuple):
+        parts.append("[")
+        for idx, val in enumerate(obj):
+            if idx > 0:
+                parts.append(",")
+            _append_hash_json(val, parts)
+        parts.append("]")
+    else:
+        parts.append(to_json(obj))
 
 
 def to_json(data):
@@ -894,13 +3314,118 @@ def _make_iterencode():
     _indent = " " * 2
     _item_separator = ","
     _key_separator = ": "
+    _missing = object()
+    _inf = float("inf")
+
+    # One-line results of the children of the values that did not fit into a single line.
+    # Each entry is removed once the child itself is encoded.
+    _one_line_cache = {}
 
     def _encode_one_line(o):
-        """Encode complex object using standard JSON encoder without line breaks,
-        and test if the result is short enough."""
-        # Possible optimization: estimate the result size by recursively adding string lengths and breaking early
-        res = _encoder(o)
-        return res if len(res) <= MAX_LINE_LENGTH else None
+        """Encode complex object without line breaks, same as the standard JSON encoder,
+        and return None if the result is longer than MAX_LINE_LENGTH."""
+        res = _one_line_cache.pop(id(o), _missing)
+        if res is _missing:
+            children = []
+            res = _one_line(o, MAX_LINE_LENGTH, children)
+            if res is None:
+                # This value will be encoded one child at a time, reuse the children that were already encoded
+                for child, child_res in children:
+                    _one_line_cache[id(child)] = child_res
+        return res
+
+    def _one_line(o, limit, children=None):
+        """Encode the object with the standard JSON one-line formatting, stopping as soon as it exceeds the limit.
+        If children list is given, it is populated with (child, result) pairs for the complex children."""
+        if isinstance(o, (list, tuple)):
+            if not o:
+                return "[]"
+            # Every value takes at least one character plus the ", " separator
+            if len(o) * 3 > limit:
+                return None
+            parts = []
+            size = 1
+            for value in o:
+                if parts:
+                    size += 2
+                if isinstance(value, (list, tuple, dict)):
+                    res = _one_line(value, limit - size - 1)
+                    if res is not None and children is not None:
+                        children.append((value, res))
+                else:
+                    res = _encode_simple(value)
+                if res is None:
+                    return None
+                size += len(res)
+                if size + 1 > limit:
+                    return None
+                parts.append(res)
+            return "[" + ", ".join(parts) + "]"
+        elif isinstance(o, dict):
+            if not o:
+                return "{}"
+            # Every key/value takes at least 5 characters, e.g. '"": 0', plus the ", " separator
+            if len(o) * 7 > limit:
+                return None
+            parts = []
+            size = 1
+            for key, value in o.items():
+                if parts:
+                    size += 2
+                key = _encoder(_convert_key(key))
+                size += len(key) + 2
+                if isinstance(value, (list, tuple, dict)):
+                    res = _one_line(value, limit - size - 1)
+                    if res is not None and children is not None:
+                        children.append((value, res))
+                else:
+                    res = _encode_simple(value)
+                if res is None:
+                    return None
+                size += len(res)
+                if size + 1 > limit:
+                    return None
+                parts.append(key + _key_separator + res)
+            return "{" + ", ".join(parts) + "}"
+        else:
+            res = _encode_simple(o)
+            return res if len(res) <= limit else None
+
+    def _encode_simple(o):
+        if isinstance(o, str):
+            return _encoder(o)
+        elif o is None:
+            return "null"
+        elif o is True:
+            return "true"
+        elif o is False:
+            return "false"
+        elif isinstance(o, int):
+            return int.__repr__(o)
+        elif isinstance(o, float) and o == o and o not in (_inf, -_inf):
+            return float.__repr__(o)
+        elif isinstance(o, float):
+            # Raises the same out of range error as the standard encoder
+            return _encoder(o)
+        else:
+            raise TypeError(f"Object of type {o.__class__.__name__} "
+                            f"is not JSON serializable")
+
+    def _convert_key(key):
+        if isinstance(key, str):
+            return key
+        elif isinstance(key, float):
+            return _encoder(key)
+        elif key is True:
+            return "true"
+        elif key is False:
+            return "false"
+        elif key is None:
+            return "null"
+        elif isinstance(key, int):
+            return _encoder(key)
+        raise TypeError(f"keys must be str, int, float, bool or None, "
+                        f"not {key.__class__.__name__}")
 
     def _iterencode_list(lst, _current_indent_level):
         if not lst:
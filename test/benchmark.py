@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2022 by Yuri Astrakhan <YuriAstrakhan@gmail.com>.
+# This code is licensed under the MIT license.
+#
+# Performance benchmarks for fatul.py, using synthetic blueprints and books.
+# The generated data is deterministic, so results of different runs can be compared.
+#
+#   python3 test/benchmark.py --output new.json --baseline old.json
+#
+
+import argparse
+import base64
+import json
+import platform
+import random
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fatul  # noqa: E402
+
+PHASES = ["decompress", "json_loads", "process_ids", "sort_dicts", "merge_shift", "to_pretty_json", "encode"]
+ENTITY_NAMES = [
+    "transport-belt", "fast-transport-belt", "inserter", "fast-inserter", "stack-inserter",
+    "assembling-machine-2", "assembling-machine-3", "beacon", "electric-furnace", "chemical-plant",
+]
+POLE_NAMES = ["medium-electric-pole", "substation"]
+COMBINATOR_NAMES = ["constant-combinator", "decider-combinator", "arithmetic-combinator"]
+STACKED_NAMES = ["straight-rail", "rail-signal", "rail-chain-signal", "small-lamp"]
+RECIPES = ["iron-gear-wheel", "electronic-circuit", "advanced-circuit", "processing-unit", "engine-unit"]
+SIGNALS = ["signal-A", "signal-B", "signal-red", "signal-green", "iron-plate", "copper-plate"]
+
+
+# Each scenario is a blueprint (or a book) generator with its parameters, scaled by --scale
+SCENARIOS = {
+    "blueprint-small": dict(entities=200, stacked=0.05, wires=0.1, trains=1),
+    "blueprint-large": dict(entities=20_000, stacked=0.05, wires=0.1, trains=20),
+    "book-nested": dict(entities=500, stacked=0.05, wires=0.1, trains=2, blueprints=100, depth=2),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fatul.py phases on synthetic blueprints and books")
+    parser.add_argument("--scenario", "-s", action="append", choices=SCENARIOS.keys(),
+                        help="Scenario to run, can be used multiple times. Runs all scenarios by default.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply the number of entities and book entries. (default = %(default)s)")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="Number of runs of each scenario, the fastest time of each phase is reported. "
+                             "(default = %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generator. (default = %(default)s)")
+    parser.add_argument("--output", "-o", type=Path, help="Save results as a JSON file")
+    parser.add_argument("--baseline", "-b", type=Path,
+                        help="A JSON file saved by a previous run with --output to compare the results with")
+    args = parser.parse_args()
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf8")) if args.baseline else None
+    if baseline is not None and (baseline.get("scale"), baseline.get("seed")) != (args.scale, args.seed):
+        print("WARNING: baseline was created with a different --scale or --seed", file=sys.stderr)
+    results = {
+        "python": platform.python_version(),
+        "numpy": fatul.numpy is not None,
+        "scale": args.scale,
+        "seed": args.seed,
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS.keys():
+        params = scale_params(SCENARIOS[name], args.scale)
+        print(f"Generating {name} {fatul.to_json(params)}", file=sys.stderr)
+        old_text, new_text = generate_scenario(params, args.seed)
+        phases = run_scenario(old_text, new_text, args.repeat)
+        results["scenarios"][name] = dict(params=params, size=len(new_text), phases=phases)
+        old_phases = None
+        if baseline is not None:
+            old_phases = baseline.get("scenarios", {}).get(name, {}).get("phases")
+        print_phases(name, phases, old_phases)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n", encoding="utf8")
+        print(f"Results saved to {args.output}", file=sys.stderr)
+
+
+def scale_params(params: dict, scale: float) -> dict:
+    result = dict(params)
+    for key in ("entities", "blueprints"):
+        if key in result:
+            result[key] = max(1, round(result[key] * scale))
+    return result
+
+
+def generate_scenario(params: dict, seed: int) -> Tuple[str, str]:
+    """Generate an old and a new version of the same blueprint or book as blueprint strings.
+    The new version has all entities shifted, and a few of them added or removed."""
+    rnd = random.Random(seed)
+    if "blueprints" in params:
+        old_data = make_book(rnd, params, params["depth"])
+    else:
+        old_data = make_blueprint(rnd, params)
+    new_data = edit_rec(rnd, json.loads(json.dumps(old_data)))
+    return encode_data(old_data), encode_data(new_data)
+
+
+def encode_data(data: dict) -> str:
+    return "0" + base64.b64encode(zlib.compress(fatul.to_json(data).encode("utf8"), 9)).decode("utf8")
+
+
+def make_book(rnd: random.Random, params: dict, depth: int) -> dict:
+    entries = []
+    for idx in range(params["blueprints"]):
+        if depth > 1 and idx % 10 == 9:
+            entry = make_book(rnd, dict(params, blueprints=max(1, params["blueprints"] // 10)), depth - 1)
+        else:
+            entry = make_blueprint(rnd, params)
+        entry["index"] = idx
+        entries.append(entry)
+    return {"blueprint_book": {
+        "item": "blueprint-book",
+        "label": f"Book {rnd.randrange(1000)}",
+        "blueprints": entries,
+        "active_index": 0,
+        "version": 281479276920832,
+    }}
+
+
+def make_blueprint(rnd: random.Random, params: dict) -> dict:
+    count = params["entities"]
+    entities = []
+    poles = []
+    combinators = []
+    # Place entities on a square area, leaving some positions empty
+    side = int((count * 1.3) ** 0.5) + 1
+    positions = rnd.sample(range(side * side), count)
+    offset_x, offset_y = rnd.randrange(-1000, 1000), rnd.randrange(-1000, 1000)
+    for pos in positions:
+        x, y = pos % side + offset_x + 0.5, pos // side + offset_y + 0.5
+        kind = rnd.random()
+        if kind < 0.08:
+            entity = new_entity(rnd.choice(POLE_NAMES), x, y)
+            poles.append(entity)
+        elif kind < 0.16:
+            entity = make_combinator(rnd, x, y)
+            combinators.append(entity)
+        else:
+            entity = new_entity(rnd.choice(ENTITY_NAMES), x, y)
+            if rnd.random() < 0.5:
+                entity["direction"] = rnd.choice([2, 4, 6])
+            if entity["name"].startswith("assembling"):
+                entity["recipe"] = rnd.choice(RECIPES)
+        entities.append(entity)
+        if rnd.random() < params["stacked"]:
+            # Stacked entities share the same position, and are referenced by their hash
+            for name in rnd.sample(STACKED_NAMES, 2):
+                entities.append(new_entity(name, x, y, direction=rnd.choice([0, 2, 4, 6])))
+
+    trains = [make_train(rnd, offset_x - 20 - 3 * idx, offset_y) for idx in range(params["trains"])]
+    for train in trains:
+        entities.extend(train)
+    for entity_number, entity in enumerate(entities, 1):
+        entity["entity_number"] = entity_number
+
+    blueprint = {
+        "item": "blueprint",
+        "label": f"Blueprint {rnd.randrange(100000)}",
+        "icons": [{"signal": {"type": "item", "name": rnd.choice(RECIPES)}, "index": 1}],
+        "entities": entities,
+        "version": 281479276920832,
+    }
+
+    # Power poles are connected to their neighbours with copper wires
+    for idx, pole in enumerate(poles):
+        neighbours = [other["entity_number"] for other in poles[idx + 1:idx + 4]]
+        if neighbours:
+            pole["neighbours"] = neighbours
+    wires = []
+    wired = combinators + poles
+    for _ in range(int(len(entities) * params["wires"])):
+        if len(wired) < 2:
+            break
+        src, dst = rnd.sample(wired, 2)
+        wires.append([src["entity_number"], rnd.choice([1, 2]), dst["entity_number"], rnd.choice([1, 2])])
+    if wires:
+        blueprint["wires"] = wires
+
+    if trains:
+        blueprint["schedules"] = [make_schedule(rnd, train) for train in trains]
+        blueprint["stock_connections"] = [
+            {"stock": stock["entity_number"], "front": front["entity_number"]}
+            for train in trains for front, stock in zip(train, train[1:])]
+    return {"blueprint": blueprint}
+
+
+def new_entity(name: str, x: float, y: float, **kwargs) -> dict:
+    # Entity number is the first key in Factorio, it is assigned once all entities are created
+    return {"entity_number": 0, "name": name, "position": {"x": x, "y": y}, **kwargs}
+
+
+def make_combinator(rnd: random.Random, x: float, y: float) -> dict:
+    return new_entity(
+        rnd.choice(COMBINATOR_NAMES), x, y,
+        direction=rnd.choice([0, 2, 4, 6]),
+        control_behavior={
+            "decider_conditions": {
+                "first_signal": {"type": "virtual", "name": rnd.choice(SIGNALS)},
+                "constant": rnd.randrange(1000),
+                "comparator": rnd.choice(["<", ">", "="]),
+                "output_signal": {"type": "virtual", "name": rnd.choice(SIGNALS)},
+                "copy_count_from_input": rnd.random() < 0.5,
+            },
+        })
+
+
+def make_train(rnd: random.Random, x: int, y: int) -> List[dict]:
+    train = [new_entity("locomotive", x, y + 3, orientation=0, items={"nuclear-fuel": rnd.randrange(1, 4)})]
+    for idx in range(rnd.randrange(2, 6)):
+        train.append(new_entity(rnd.choice(["cargo-wagon", "fluid-wagon"]), x, y + 10 + 7 * idx, orientation=0))
+    return train
+
+
+def make_schedule(rnd: random.Random, train: List[dict]) -> dict:
+    stations = []
+    for _ in range(rnd.randrange(2, 5)):
+        stations.append({
+            "station": f"Station {rnd.randrange(100)}",
+            "wait_conditions": [{"compare_type": "or", "type": rnd.choice(["full", "empty", "inactivity"])}],
+        })
+    return {"locomotives": [train[0]["entity_number"]], "schedule": stations}
+
+
+def edit_rec(rnd: random.Random, data: Any) -> Any:
+    """Shift all entities of every blueprint, and add or remove a few of them"""
+    if type(data) == dict:
+        if "blueprint" in data:
+            edit_blueprint(rnd, data["blueprint"])
+        else:
+            for val in data.values():
+                edit_rec(rnd, val)
+    elif type(data) == list:
+        for val in data:
+            edit_rec(rnd, val)
+    return data
+
+
+def edit_blueprint(rnd: random.Random, blueprint: dict) -> None:
+    shift_x, shift_y = rnd.randrange(-50, 50), rnd.randrange(-50, 50)
+    entities = blueprint.get("entities", [])
+    referenced = {wire[i] for wire in blueprint.get("wires", []) for i in (0, 2)}
+    referenced.update(v for entity in entities for v in entity.get("neighbours", []))
+    for item in blueprint.get("schedules", []):
+        referenced.update(item["locomotives"])
+    for item in blueprint.get("stock_connections", []):
+        referenced.update(item.values())
+    # Keep the referenced entities, so that all references stay valid
+    kept = [entity for entity in entities if entity["entity_number"] in referenced or rnd.random() >= 0.02]
+    max_x = max((e["position"]["x"] for e in entities), default=0)
+    next_number = max((e["entity_number"] for e in entities), default=0) + 1
+    for idx in range(len(entities) // 50):
+        entity = new_entity(rnd.choice(ENTITY_NAMES), max_x + 2 + idx % 10, idx // 10 + 0.5)
+        entity["entity_number"] = next_number
+        next_number += 1
+        kept.append(entity)
+    for entity in kept:
+        entity["position"] = {"x": entity["position"]["x"] + shift_x, "y": entity["position"]["y"] + shift_y}
+    if entities:
+        blueprint["entities"] = kept
+
+
+def run_scenario(old_text: str, new_text: str, repeat: int) -> Dict[str, float]:
+    """Run all phases repeat times, and return the fastest time of each phase in seconds"""
+    best: Dict[str, float] = {}
+    for _ in range(repeat):
+        for phase, duration in run_phases(old_text, new_text).items():
+            best[phase] = min(best.get(phase, duration), duration)
+    return {phase: round(best[phase], 6) for phase in PHASES if phase in best}
+
+
+def run_phases(old_text: str, new_text: str) -> Dict[str, float]:
+    times: Dict[str, float] = {}
+
+    def timed(phase: str, func: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = func()
+        times[phase] = times.get(phase, 0) + time.perf_counter() - start
+        return result
+
+    processor = fatul.Processor(False, "all", "refs", normalize_shift=True, compact=True,
+                                merge_index=True, merge_shift=True)
+    old_data = processor.decode(old_text)
+
+    raw = timed("decompress", lambda: zlib.decompress(base64.b64decode(new_text[1:])).decode("utf8"))
+    data = timed("json_loads", lambda: json.loads(raw))
+    timed("process_ids", lambda: processor.process_ids(data, to_abs_ids=False))
+    # The blueprints are sorted by process_ids(), only the rest of the data is sorted here
+    timed("sort_dicts", lambda: fatul.sort_dicts_rec(data, skip_blueprints=True))
+    for old_bp, new_bp in zip(iter_blueprints(old_data), iter_blueprints(data)):
+        timed("merge_shift", lambda: fatul.Blueprint(processor, new_bp, False).merge_shift_from_old(
+            fatul.Blueprint(processor, old_bp, False)))
+    text = timed("to_pretty_json", lambda: fatul.to_pretty_json(data, True))
+
+    data = json.loads(text)
+    timed("encode", lambda: fatul.Processor(False).encode(data))
+    return times
+
+
+def iter_blueprints(data: Any):
+    if type(data) == dict:
+        if "blueprint" in data:
+            yield data
+        else:
+            for val in data.values():
+                yield from iter_blueprints(val)
+    elif type(data) == list:
+        for val in data:
+            yield from iter_blueprints(val)
+
+
+def print_phases(name: str, phases: Dict[str, float], old_phases: Optional[Dict[str, float]]) -> None:
+    print(f"{name}:")
+    total = sum(phases.values())
+    for phase, duration in list(phases.items()) + [("total", total)]:
+        line = f"  {phase:<16}{duration:9.4f}s"
+        if old_phases is not None:
+            old = sum(old_phases.values()) if phase == "total" else old_phases.get(phase)
+            if old:
+                line += f"  {old:9.4f}s  {duration / old - 1:+7.1%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()